@@ -24,9 +24,12 @@
 from __future__ import with_statement
 
 from datetime import datetime
+import logging
 import sys
+import time
 
 from nose.tools import eq_ as eq
+from nose.plugins.skip import SkipTest
 from .couch_util import setup, teardown, with_couchdb
 from .util import with_ioloop, DatetimeEncoder
 
@@ -44,8 +47,14 @@ except ImportError:
     from urllib2 import urlopen
     from urllib2 import HTTPError
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 import trombi
 import trombi.errors
+import trombi.tracing
 
 
 def test_from_uri():
@@ -1810,3 +1819,1057 @@ def test_create_document_with_custom_encoder(baseurl, ioloop):
     s = trombi.Server(baseurl, io_loop=ioloop, json_encoder=DatetimeEncoder)
     s.create('testdb', callback=create_db_callback)
     ioloop.start()
+
+
+def test_unknown_transport():
+    try:
+        trombi.Server('http://localhost:5984', transport='carrier-pigeon')
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
+@with_ioloop
+@with_couchdb
+def test_pool_stats_queued(baseurl, ioloop):
+    def do_test(db):
+        infos = []
+
+        def info_callback(info):
+            eq(info.error, False)
+            infos.append(info)
+            if len(infos) == 3:
+                stats = s.pool_stats()
+                eq(stats['active'], 0)
+                eq(stats['queued'], 0)
+                assert stats['requests'] >= 4
+                assert stats['new_connections'] >= 1
+                ioloop.stop()
+
+        for i in range(3):
+            db.info(info_callback)
+
+        stats = s.pool_stats()
+        eq(stats['active'], 1)
+        eq(stats['queued'], 2)
+
+    s = trombi.Server(baseurl, io_loop=ioloop, transport='simple',
+                      max_connections=1)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_create_document_gzip_body(baseurl, ioloop):
+    def create_db_callback(db):
+        db.set(
+            {'testvalue': 'something ' * 100},
+            create_doc_callback,
+            )
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        assert doc.id
+        assert doc.rev
+        stats = s.compression_stats()
+        eq(stats['compressed_requests'], 1)
+        assert stats['request_bytes'] > stats['request_bytes_compressed']
+        assert stats['request_ratio'] < 1
+        doc.db.get(doc.id, get_doc_callback)
+
+    def get_doc_callback(doc):
+        eq(doc['testvalue'], 'something ' * 100)
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, gzip_threshold=100)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_changes_hub(baseurl, ioloop):
+    def do_test(db):
+        all_changes = []
+        filtered_changes = []
+
+        def _got_change(change):
+            all_changes.append(change)
+            check()
+
+        def _got_filtered_change(change):
+            filtered_changes.append(change)
+            check()
+
+        def check():
+            if len(all_changes) == 2 and len(filtered_changes) == 1:
+                eq([c['id'] for c in all_changes], ['first', 'second'])
+                eq(filtered_changes[0]['id'], 'second')
+                # The change is parsed only once
+                assert filtered_changes[0] is all_changes[1]
+
+                first.cancel()
+                second.cancel()
+                assert not hub.running
+                ioloop.stop()
+
+        hub = db.changes_hub(since=0)
+        assert db.changes_hub(since=0) is hub
+        first = hub.subscribe(_got_change)
+        second = hub.subscribe(_got_filtered_change, doc_ids=['second'])
+        eq(hub.subscribers, 2)
+        assert hub.running
+
+        def first_created(doc):
+            db.set('second', {'more': 'data'}, lambda x: None)
+
+        db.set('first', {'some': 'data'}, first_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_replicate(baseurl, ioloop):
+    s = trombi.Server(baseurl, io_loop=ioloop)
+
+    def do_test(source):
+        def bulk_callback(result):
+            eq(result.error, False)
+            s.create('target', callback=target_created)
+
+        def target_created(target):
+            replicator = trombi.Replicator(source, target, batch_size=2)
+            replicator.start(replicated)
+
+        def replicated(stats):
+            eq(stats.error, False)
+            eq(stats['changes_read'], 5)
+            eq(stats['missing_found'], 5)
+            eq(stats['docs_written'], 5)
+            eq(stats['doc_write_failures'], 0)
+            eq(stats['last_seq'], 5)
+            s.get('target', callback=check_target)
+
+        def check_target(target):
+            target.get('doc3', callback=check_doc)
+
+        def check_doc(doc):
+            eq(doc['value'], 3)
+
+            # A second replication continues from the checkpoint
+            trombi.Replicator(source, doc.db).start(replicated_again)
+
+        def replicated_again(stats):
+            eq(stats.error, False)
+            eq(stats['changes_read'], 0)
+            eq(stats['docs_written'], 0)
+            ioloop.stop()
+
+        source.bulk_docs(
+            [{'_id': 'doc%d' % i, 'value': i} for i in range(5)],
+            bulk_callback,
+            )
+
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_get(baseurl, ioloop):
+    def do_test(db):
+        def bulk_callback(result):
+            eq(result.error, False)
+            db.bulk_get(
+                [('doc2', result[2]['rev']), 'missing', 'doc0'],
+                bulk_get_callback,
+                chunk_size=2,
+                )
+
+        def bulk_get_callback(result):
+            eq(result.error, False)
+            eq(len(result), 3)
+            assert isinstance(result[0], trombi.Document)
+            eq(result[0].id, 'doc2')
+            eq(result[0]['value'], 2)
+            assert isinstance(result[1], trombi.BulkError)
+            eq(result[1].error_type, 'not_found')
+            eq(result[2].id, 'doc0')
+            ioloop.stop()
+
+        db.bulk_docs(
+            [{'_id': 'doc%d' % i, 'value': i} for i in range(3)],
+            bulk_callback,
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_get_missing_database(baseurl, ioloop):
+    def bulk_get_callback(result):
+        eq(result.error, True)
+        eq(result.errno, trombi.errors.NOT_FOUND)
+        # A missing database doesn't mean a missing endpoint
+        eq(s._bulk_get_supported, True)
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    trombi.Database(s, 'nonexistent').bulk_get(['doc0'], bulk_get_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_get_many(baseurl, ioloop):
+    def do_test(db):
+        def bulk_callback(result):
+            eq(result.error, False)
+            db.get_many(['doc3', 'missing', 'doc0', 'doc4'], get_many_callback,
+                        chunk_size=2, concurrency=2)
+
+        def get_many_callback(result):
+            eq(result.error, False)
+            docs = result.content
+            eq(len(docs), 4)
+            eq(docs[0]['value'], 3)
+            eq(docs[1], None)
+            eq(docs[2]['value'], 0)
+            eq(docs[3].id, 'doc4')
+            ioloop.stop()
+
+        db.bulk_docs(
+            [{'_id': 'doc%d' % i, 'value': i} for i in range(5)],
+            bulk_callback,
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_view_many(baseurl, ioloop):
+    def do_test(db):
+        def create_view_callback(response):
+            eq(response.code, 201)
+            db.bulk_docs(
+                [{'_id': 'doc%d' % i, 'value': i % 2} for i in range(4)],
+                bulk_callback,
+                )
+
+        def bulk_callback(result):
+            eq(result.error, False)
+            db.view_many('testview', 'by_value', [1, 5, 0],
+                         view_many_callback, chunk_size=1)
+
+        def view_many_callback(result):
+            eq(result.error, False)
+            eq([x['key'] for x in result], [1, 1, 0, 0])
+            eq(result.missing, [5])
+            ioloop.stop()
+
+        db.server._fetch(
+            '%stestdb/_design/testview' % baseurl,
+            create_view_callback,
+            method='PUT',
+            body=json.dumps(
+                {
+                    'language': 'javascript',
+                    'views': {
+                        'by_value': {
+                            'map': '(function (doc) { emit(doc.value, null) })',
+                            }
+                        }
+                    }
+                )
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_update_handler_increment(baseurl, ioloop):
+    def do_test(db):
+        def handlers_installed(doc):
+            eq(doc.error, False)
+            db.set('counter', {'hits': 1}, doc_created)
+
+        def doc_created(doc):
+            db.update_handler('trombi', 'increment', incremented,
+                              doc_id='counter',
+                              body={'field': 'hits', 'by': 2})
+
+        def incremented(result):
+            eq(result.error, False)
+            eq(result.content, {'ok': True, 'value': 3})
+            eq(result.id, 'counter')
+            assert result.rev.startswith('2-')
+            db.get('counter', got_doc)
+
+        def got_doc(doc):
+            eq(doc['hits'], 3)
+            ioloop.stop()
+
+        db.install_update_handlers(handlers_installed)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_create_document_batch(baseurl, ioloop):
+    def create_db_callback(db):
+        db.set(
+            'batchdoc',
+            {'testvalue': 'something'},
+            create_doc_callback,
+            batch=True,
+            )
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        assert isinstance(doc, trombi.Document)
+        eq(doc.id, 'batchdoc')
+        eq(doc.rev, None)
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_update_document_batch(baseurl, ioloop):
+    def create_db_callback(db):
+        db.set('batchdoc', {'testvalue': 'something'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        assert doc.rev.startswith('1-')
+        doc['testvalue'] = 'something else'
+        doc.db.set(doc, update_doc_callback, batch=True)
+
+    def update_doc_callback(doc):
+        eq(doc.error, False)
+        eq(doc.id, 'batchdoc')
+        # The new revision is not known yet
+        eq(doc.rev, None)
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+def test_set_invalid_keyword_argument():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    try:
+        db.set({'foo': 'bar'}, lambda x: None, bogus=True)
+    except TypeError:
+        e = sys.exc_info()[1]
+        eq(str(e), 'bogus is invalid keyword argument for this function')
+    else:
+        assert False, 'TypeError not raised'
+
+
+def test_find_result():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    result = trombi.FindResult(
+        {'docs': [{'_id': 'foo', 'value': 1}], 'bookmark': 'g1AAAA'},
+        db, {'selector': {'value': 1}})
+    eq(result.error, False)
+    eq(len(result), 1)
+    assert isinstance(result[0], trombi.Document)
+    eq(result[0].id, 'foo')
+    eq(result.bookmark, 'g1AAAA')
+    eq(result.warning, None)
+
+
+@with_ioloop
+@with_couchdb
+def test_view_results_include_docs_shared(baseurl, ioloop):
+    def do_test(db):
+        def create_view_callback(response):
+            eq(response.code, 201)
+            db.bulk_docs([
+                {'_id': 'post'},
+                {'_id': 'comment1', 'post': 'post'},
+                {'_id': 'comment2', 'post': 'post'},
+                ], bulk_callback)
+
+        def bulk_callback(result):
+            eq(result.error, False)
+            db.view('testview', 'posts', load_view_cb, include_docs=True)
+
+        def load_view_cb(result):
+            eq(result.error, False)
+            eq(len(result), 2)
+            first, second = [x['doc'] for x in result]
+            eq(first.id, 'post')
+            assert first is second
+            # Formatting the rows again keeps the documents intact
+            eq(result[0]['doc'].id, 'post')
+            ioloop.stop()
+
+        db.server._fetch(
+            '%stestdb/_design/testview' % baseurl,
+            create_view_callback,
+            method='PUT',
+            body=json.dumps(
+                {
+                    'language': 'javascript',
+                    'views': {
+                        'posts': {
+                            'map': '(function (doc) { if (doc.post) '
+                                   'emit(doc._id, {_id: doc.post}) })',
+                            }
+                        }
+                    }
+                )
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+def test_document_dirty():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    doc = trombi.Document(db, {'_id': 'foo', '_rev': '1-abc', 'tags': []})
+    eq(doc.dirty, False)
+    doc['tags'] = []
+    eq(doc.dirty, False)
+    doc['tags'].append('bar')
+    eq(doc.dirty, False)
+    doc['tags'] = doc['tags']
+    eq(doc.dirty, True)
+    doc.mark_clean()
+    eq(doc.dirty, False)
+    del doc['tags']
+    eq(doc.dirty, True)
+
+    db.server.track_nested_changes = True
+    doc = trombi.Document(db, {'_id': 'foo', '_rev': '1-abc', 'tags': []})
+    eq(doc.dirty, False)
+    doc['tags'].append('bar')
+    eq(doc.dirty, True)
+
+    eq(trombi.Document(db, {'foo': 'bar'}).dirty, True)
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_docs_skip_clean(baseurl, ioloop):
+    def create_db_callback(db):
+        db.bulk_docs(
+            [{'_id': 'first', 'value': 1}, {'_id': 'second', 'value': 2}],
+            lambda result: db.get_many(
+                ['first', 'second'], get_many_callback),
+            )
+
+    def get_many_callback(result):
+        eq(result.error, False)
+        first, second = result.content
+        second['value'] = 3
+        result.content[0].db.bulk_docs(
+            [first, second],
+            lambda result: bulk_callback(result, first, second),
+            skip_clean=True,
+            )
+
+    def bulk_callback(result, first, second):
+        eq(result.error, False)
+        eq(len(result), 2)
+        eq(result[0]['skipped'], True)
+        eq(result[0]['rev'], first.rev)
+        assert 'skipped' not in result[1]
+        eq(result[1]['rev'], second.rev)
+        assert second.rev.startswith('2-')
+        eq(second.dirty, False)
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_continuous_changes_feed_max_pending(baseurl, ioloop):
+    def do_test(db):
+        received = []
+
+        def _got_change(change):
+            received.append(change['id'])
+            # Handle the changes one at a time, later
+            ioloop.add_timeout(time.time() + 0.05, feed.ack)
+            if len(received) == 3:
+                eq(received, ['first', 'second', 'third'])
+                assert feed.pauses >= 1
+                feed.stop()
+                ioloop.stop()
+
+        def docs_created(result):
+            assert not result.error
+
+        feed = db.changes(
+            _got_change, feed='continuous', since=0,
+            max_pending=1, manual_ack=True)
+        db.bulk_docs(
+            [{'_id': 'first'}, {'_id': 'second'}, {'_id': 'third'}],
+            docs_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+def test_changes_max_pending_needs_continuous_feed():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    try:
+        db.changes(lambda x: None, max_pending=10)
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
+@with_ioloop
+@with_couchdb
+def test_follow_changes(baseurl, ioloop):
+    def do_test(db):
+        received = []
+        followers = []
+
+        def _got_change(change):
+            received.append(change['id'])
+            if len(received) == 4:
+                eq(received, ['a', 'b', 'c', 'd'])
+                stats = followers[0].stats()
+                eq(stats['mode'], 'continuous')
+                eq(stats['changes'], 4)
+                eq(stats['catchup_changes'], 3)
+                eq(stats['pending'], 0)
+                eq(stats['lag'], None)
+                assert stats['batches'] >= 2
+                followers[0].stop()
+                ioloop.stop()
+
+        def caught_up(follower):
+            eq(follower.mode, 'continuous')
+            db.set('d', {}, lambda x: None)
+
+        def docs_created(result):
+            assert not result.error
+            followers.append(db.follow(
+                _got_change, batch_size=2, threshold=0,
+                caught_up_callback=caught_up))
+
+        db.bulk_docs([{'_id': 'a'}, {'_id': 'b'}, {'_id': 'c'}], docs_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+class RecordingSpan(trombi.tracing.Span):
+    def __init__(self, name, parent, tags):
+        self.name = name
+        self.parent = parent
+        self.tags = dict(tags or {})
+        self.events = []
+        self.finished = False
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+    def log_event(self, event, timestamp=None):
+        self.events.append(event)
+
+    def finish(self):
+        self.finished = True
+
+
+class RecordingTracer(trombi.tracing.Tracer):
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, operation_name, parent=None, tags=None):
+        span = RecordingSpan(operation_name, parent, tags)
+        self.spans.append(span)
+        return span
+
+
+@with_ioloop
+@with_couchdb
+def test_tracing_spans(baseurl, ioloop):
+    tracer = RecordingTracer()
+
+    def create_db_callback(db):
+        db.set('mydoc', {'some': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        doc.db.get('mydoc', get_doc_callback)
+
+    def get_doc_callback(doc):
+        eq(doc.error, False)
+        create, set, get = tracer.spans
+        eq(set.name, 'couchdb.set')
+        eq(set.tags['db'], 'testdb')
+        eq(set.tags['target'], 'mydoc')
+        eq(set.tags['http.status_code'], 201)
+        eq(set.events, ['sent', 'response'])
+        assert set.finished
+        assert 'decode_time' in set.tags
+        # The get was started in the callback of the set
+        assert get.parent is set
+        eq(get.tags['op'], 'get')
+        assert not get.finished
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, tracer=tracer)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_tracing_scheduled_callbacks(baseurl, ioloop):
+    tracer = RecordingTracer()
+    root = RecordingSpan('root', None, None)
+
+    def create_db_callback(db):
+        db.set('mydoc', {'some': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        with trombi.tracing.activate(root):
+            # Nothing to save, the callback is run through the IOLoop
+            doc.db.set(doc, skipped_callback, skip_clean=True)
+
+    def skipped_callback(doc):
+        eq(trombi.tracing.active_span(), root)
+        doc.db.get('mydoc', get_doc_callback)
+
+    def get_doc_callback(doc):
+        eq(doc.error, False)
+        eq(tracer.spans[-1].name, 'couchdb.get')
+        assert tracer.spans[-1].parent is root
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, tracer=tracer)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@with_ioloop
+@with_couchdb
+def test_slow_request_log(baseurl, ioloop):
+    handler = RecordingHandler()
+    logger = logging.getLogger('trombi.slow')
+    logger.addHandler(handler)
+
+    def create_db_callback(db):
+        db.set('mydoc', {'some': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        # The entry is logged after the callback returns
+        ioloop.add_callback(check)
+
+    def check():
+        logger.removeHandler(handler)
+        message = handler.messages[-1]
+        assert message.startswith(
+            'Slow request: PUT /{db}/{docid} (testdb) status 201'), message
+        assert 'bytes sent' in message
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, slow_request_threshold=0)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_decode_in_executor(baseurl, ioloop):
+    if ThreadPoolExecutor is None:
+        raise SkipTest('concurrent.futures is not available')
+    executor = ThreadPoolExecutor(1)
+
+    def create_db_callback(db):
+        db.set('mydoc', {'some': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        doc.db.get('mydoc', get_doc_callback)
+
+    def get_doc_callback(doc):
+        eq(doc.error, False)
+        eq(doc['some'], 'data')
+        executor.shutdown()
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, executor=executor,
+                      decode_threshold=0)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_encode_in_executor(baseurl, ioloop):
+    if ThreadPoolExecutor is None:
+        raise SkipTest('concurrent.futures is not available')
+    executor = ThreadPoolExecutor(1)
+    created = []
+
+    def create_db_callback(db):
+        # The first request is encoded in the executor, but it's still
+        # sent before the second one
+        db.set('first', {'some': 'data'}, create_doc_callback,
+               attachments={'foo': (None, b'bar')})
+        db.set('second', {'more': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        created.append(doc)
+        if len(created) == 2:
+            eq([d.id for d in created], ['first', 'second'])
+            eq(created[0].attachments['foo']['content_type'], 'text/plain')
+            created[0].db.changes(changes_callback, since=0)
+
+    def changes_callback(changes):
+        eq([c['id'] for c in changes.content['results']],
+           ['first', 'second'])
+        executor.shutdown()
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, executor=executor,
+                      encode_threshold=0)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_encode_in_executor_failed(baseurl, ioloop):
+    if ThreadPoolExecutor is None:
+        raise SkipTest('concurrent.futures is not available')
+    executor = ThreadPoolExecutor(1)
+    results = []
+
+    def create_db_callback(db):
+        db.set('first', {'some': object()}, create_doc_callback)
+        db.set('second', {'more': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        results.append(doc)
+        if len(results) == 2:
+            # The failed request doesn't hold up the next one
+            eq(results[0].error, True)
+            eq(results[0].errno, trombi.errors.ENCODING_FAILED)
+            eq(results[1].error, False)
+            eq(results[1].id, 'second')
+            executor.shutdown()
+            ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, executor=executor,
+                      encode_threshold=0)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+def test_load_inline_attachment_cached():
+    db = trombi.from_uri('http://localhost:5984/testdb/',
+                         drop_attachment_data=True)
+    doc = trombi.Document(db, {
+        '_id': 'foo',
+        '_rev': '1-abc',
+        '_attachments': {
+            'bar': {
+                'content_type': 'text/plain',
+                'revpos': 1,
+                'data': 'c29tZSBkYXRh',
+                },
+            },
+        })
+    loaded = []
+    doc.load_attachment('bar', loaded.append)
+    doc.load_attachment('bar', loaded.append)
+    eq(loaded, [b'some data', b'some data'])
+    # Only the decoded data is kept
+    eq(doc.attachments['bar'], {
+        'content_type': 'text/plain',
+        'revpos': 1,
+        'stub': True,
+        })
+    eq(doc.dirty, False)
+    # The decoded data of a replaced attachment is dropped
+    doc.attachments['bar'] = {'content_type': 'text/plain', 'stub': True}
+    doc._prune_decoded_attachments()
+    eq(doc._decoded_attachments, {})
+
+
+@with_ioloop
+@with_couchdb
+def test_warm_views(baseurl, ioloop):
+    def do_test(db):
+        progress = []
+
+        def create_view_callback(response):
+            eq(response.code, 201)
+            db.bulk_docs(
+                [{'_id': 'doc%d' % i, 'value': i} for i in range(10)],
+                bulk_callback,
+                )
+
+        def bulk_callback(result):
+            eq(result.error, False)
+            db.warm_views('testview', warm_callback, poll_interval=0.1,
+                          progress_callback=progress.append)
+
+        def warm_callback(result):
+            eq(result.error, False)
+            eq(result.to_basetype(), {'testview': 100})
+            assert progress
+            # The index is up to date now
+            db.view('testview', 'by_value', view_callback, stale='ok')
+
+        def view_callback(result):
+            eq(result.error, False)
+            eq(len(result), 10)
+            ioloop.stop()
+
+        db.server._fetch(
+            '%stestdb/_design/testview' % baseurl,
+            create_view_callback,
+            method='PUT',
+            body=json.dumps(
+                {
+                    'language': 'javascript',
+                    'views': {
+                        'by_value': {
+                            'map': '(function (doc) { emit(doc.value, null) })',
+                            }
+                        }
+                    }
+                )
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+def test_warm_views_nothing_to_warm():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    results = []
+    db.warm_views([], results.append)
+    eq([result.to_basetype() for result in results], [{}])
+
+
+def test_view_query_params():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    urls = []
+    db._fetch = lambda url, *args, **kwargs: urls.append(url)
+    db.view('testview', 'by_value', lambda x: None, stale='ok')
+    db.view('testview', 'by_value', lambda x: None, update=False)
+    eq(urls, ['_design/testview/_view/by_value?stale=ok',
+              '_design/testview/_view/by_value?update=false'])
+
+
+@with_ioloop
+@with_couchdb
+def test_view_stale_read_policy(baseurl, ioloop):
+    def do_test(db):
+        def create_view_callback(response):
+            eq(response.code, 201)
+            db.set('first', {'value': 1}, first_created)
+
+        def first_created(doc):
+            eq(doc.error, False)
+            # The first stale read updates the index after answering
+            db.view('testview', 'by_value', first_view)
+
+        def first_view(result):
+            eq(result.error, False)
+            eq(urls[-1], '_design/testview/_view/by_value?stale=update_after')
+            db.set('second', {'value': 2}, second_created)
+
+        def second_created(doc):
+            eq(doc.error, False)
+            # Within the refresh interval the index is not touched
+            db.view('testview', 'by_value', second_view)
+
+        def second_view(result):
+            eq(result.error, False)
+            eq(urls[-1], '_design/testview/_view/by_value?stale=ok')
+            db.view('testview', 'by_value', fresh_view, read_policy='fresh')
+
+        def fresh_view(result):
+            eq(result.error, False)
+            eq(urls[-1], '_design/testview/_view/by_value')
+            eq(len(result), 2)
+            ioloop.stop()
+
+        urls = []
+        fetch = db._fetch
+
+        def _fetch(url, *args, **kwargs):
+            urls.append(url)
+            fetch(url, *args, **kwargs)
+
+        db._fetch = _fetch
+
+        db.server._fetch(
+            '%stestdb/_design/testview' % baseurl,
+            create_view_callback,
+            method='PUT',
+            body=json.dumps(
+                {
+                    'language': 'javascript',
+                    'views': {
+                        'by_value': {
+                            'map': '(function (doc) { emit(doc.value, null) })',
+                            }
+                        }
+                    }
+                )
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop, view_read_policy='stale')
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+def test_view_unknown_read_policy():
+    db = trombi.from_uri('http://localhost:5984/testdb/')
+    try:
+        db.view('testview', 'by_value', lambda x: None, read_policy='bogus')
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
+@with_ioloop
+@with_couchdb
+def test_compaction_scheduler(baseurl, ioloop):
+    def create_db_callback(db):
+        scheduler = db.server.compaction_scheduler(
+            threshold=0, poll_interval=0.1)
+        assert db.server.compaction_scheduler() is scheduler
+        db.set('mydoc', {'some': 'data'}, lambda doc: scheduler.check(
+            [db, 'otherdb', 'testdb'], check_callback))
+
+    def check_callback(results):
+        eq(results.error, False)
+        compacted, missing, again = results.content
+        eq(compacted.error, False)
+        eq(compacted.content, 'compacted')
+        eq(missing.errno, trombi.errors.NOT_FOUND)
+        eq(again.content, 'compacted')
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+def test_compaction_scheduler_created_once():
+    s = trombi.Server('http://localhost:5984/')
+    scheduler = s.compaction_scheduler(threshold=3)
+    assert s.compaction_scheduler() is scheduler
+    try:
+        s.compaction_scheduler(threshold=4)
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
+@with_ioloop
+@with_couchdb
+def test_watch_seq(baseurl, ioloop):
+    def create_db_callback(db):
+        infos = []
+
+        def _got_info(info):
+            infos.append(info)
+            if len(infos) == 2:
+                # The calls shared one request, but got copies of
+                # their own
+                eq(infos[0], infos[1])
+                assert infos[0] is not infos[1]
+                db.watch_seq(_seq_moved)
+                db.server.io_loop.add_timeout(
+                    time.time() + 0.2,
+                    lambda: db.set('mydoc', {'some': 'data'}, lambda x: None))
+
+        def _seq_moved(info):
+            eq(info.error, False)
+            eq(info['doc_count'], 1)
+            ioloop.stop()
+
+        db.info(_got_info)
+        db.info(_got_info)
+
+    s = trombi.Server(baseurl, io_loop=ioloop, info_cache_ttl=0.05,
+                      seq_poll_interval=0.1)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_collect_info(baseurl, ioloop):
+    def create_db_callback(db):
+        db.set('mydoc', {'some': 'data'}, set_callback)
+
+    def set_callback(doc):
+        names = []
+        s.collect_info(
+            collect_callback, names=['testdb', 'nonexistent'],
+            concurrency=2, batch_size=1,
+            info_callback=lambda name, info: names.append(name))
+
+        def collect_callback(summary):
+            eq(summary.error, False)
+            eq(sorted(names), ['nonexistent', 'testdb'])
+            eq(summary['databases'], 1)
+            eq(summary['doc_count'], 1)
+            eq(list(summary['errors'].keys()), ['nonexistent'])
+            assert summary['disk_size'] > 0
+            ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
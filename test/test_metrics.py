@@ -0,0 +1,101 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from nose.tools import eq_ as eq
+from .couch_util import setup, teardown, with_couchdb
+from .util import with_ioloop
+
+import trombi
+from trombi.client import _request_info
+from trombi.metrics import Metrics
+
+
+def test_request_info():
+    eq(_request_info('/', 'GET'), (None, 'server', None, '/'))
+    eq(_request_info('/_session', 'POST'),
+       (None, 'session', None, '/_session'))
+    eq(_request_info('/testdb', 'PUT'),
+       ('testdb', 'database', None, '/{db}'))
+    eq(_request_info('/testdb/mydoc?rev=1-abc', 'GET'),
+       ('testdb', 'get', 'mydoc', '/{db}/{docid}'))
+    eq(_request_info('/testdb/mydoc/file.txt', 'PUT'),
+       ('testdb', 'attachment', 'mydoc', '/{db}/{docid}/{attachment}'))
+    eq(_request_info('/testdb/_design/app', 'PUT'),
+       ('testdb', 'set', '_design/app', '/{db}/_design/{docid}'))
+    eq(_request_info('/testdb/_design/app/_view/all?limit=1', 'GET'),
+       ('testdb', 'view', 'app/all', '/{db}/_design/{ddoc}/_view/{name}'))
+    eq(_request_info('/testdb/_changes?feed=continuous', 'GET'),
+       ('testdb', 'changes', '_changes', '/{db}/_changes'))
+    eq(_request_info('/testdb/_bulk_docs', 'POST'),
+       ('testdb', 'bulk_docs', '_bulk_docs', '/{db}/_bulk_docs'))
+
+
+def test_metrics_render():
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.request_started('get', 'testdb')
+    metrics.request_started('get', 'testdb')
+    metrics.request_finished('get', 'testdb', 200, 0.05, 0, 120)
+    metrics.request_started('set', 'testdb')
+    metrics.request_finished('set', 'testdb', 409, 0.5, 30, 60)
+
+    lines = metrics.render().splitlines()
+    for line in [
+        '# TYPE trombi_request_duration_seconds histogram',
+        'trombi_request_duration_seconds_bucket'
+        '{op="get",db="testdb",le="0.1"} 1',
+        'trombi_request_duration_seconds_bucket'
+        '{op="set",db="testdb",le="0.1"} 0',
+        'trombi_request_duration_seconds_bucket'
+        '{op="set",db="testdb",le="1.0"} 1',
+        'trombi_request_duration_seconds_bucket'
+        '{op="set",db="testdb",le="+Inf"} 1',
+        'trombi_request_duration_seconds_count{op="get",db="testdb"} 1',
+        'trombi_request_bytes_total{op="set",db="testdb"} 30',
+        'trombi_response_bytes_total{op="get",db="testdb"} 120',
+        'trombi_request_errors_total{op="set",db="testdb",code="409"} 1',
+        'trombi_requests_in_flight{op="get",db="testdb"} 1',
+        'trombi_requests_in_flight{op="set",db="testdb"} 0',
+        ]:
+        assert line in lines, line
+
+
+@with_ioloop
+@with_couchdb
+def test_server_metrics(baseurl, ioloop):
+    metrics = Metrics()
+
+    def create_db_callback(db):
+        db.set('mydoc', {'some': 'data'}, create_doc_callback)
+
+    def create_doc_callback(doc):
+        eq(doc.error, False)
+        text = metrics.render()
+        assert 'trombi_request_duration_seconds_count' \
+            '{op="set",db="testdb"} 1' in text
+        assert 'trombi_connections{server="%s",state="active"} 0' % (
+            baseurl.rstrip('/')) in text
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, metrics=metrics)
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
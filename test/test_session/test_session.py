@@ -94,13 +94,10 @@ def test_session_with_user(baseurl, ioloop):
     s.session(session_callback)
     ioloop.start()
 
-    # check that no cookie has been sent and the session info is correct
-    eq(result['session_info'].content,
-       {u'info': {u'authentication_handlers':
-            [u'oauth', u'cookie', u'default'], u'authentication_db':
-            u'_users'}, u'userCtx': {u'name': None, u'roles': []},
-                                u'ok':
-            True})
+    # check that the cookie has been sent and the session info is
+    # correct
+    eq(result['session_info'].content['userCtx'],
+       {u'name': u'testuser', u'roles': []})
 
     # check that logout is working
     s.logout(session_callback)
@@ -108,3 +105,44 @@ def test_session_with_user(baseurl, ioloop):
 
     assert not s.session_cookie
     eq(result['session_info'].content, {u'ok': True})
+
+
+@with_ioloop
+@with_couchdb
+def test_session_auth(baseurl, ioloop):
+    def create_db_callback(db):
+        eq(db.error, False)
+        assert s.session_cookie.startswith('AuthSession=')
+        s.session(session_callback)
+
+    def session_callback(result):
+        eq(result.error, False)
+        eq(result.content['userCtx']['name'], 'admin')
+        ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop,
+                      session_auth=('admin', 'admin'))
+    s.create('testdb', callback=create_db_callback)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_session_auth_failed(baseurl, ioloop):
+    results = []
+
+    def create_db_callback(db):
+        results.append(db)
+        if len(results) == 2:
+            # Both of the requests waited for the same login
+            for result in results:
+                eq(result.error, True)
+                eq(result.errno, 401)
+            eq(s.session_cookie, None)
+            ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop,
+                      session_auth=('admin', 'wrong'))
+    s.create('testdb1', callback=create_db_callback)
+    s.create('testdb2', callback=create_db_callback)
+    ioloop.start()
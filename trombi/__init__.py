@@ -20,3 +20,4 @@
 # THE SOFTWARE.
 
 from .client import *
+from .replicator import Replicator
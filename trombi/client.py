@@ -23,14 +23,17 @@
 
 """Asynchronous CouchDB client"""
 
+import copy
 import functools
 from hashlib import sha1
+import random
 import uuid
 import logging
 import re
 import collections
+import time
+import zlib
 import tornado.ioloop
-import urllib
 
 try:
     # Python 3
@@ -45,7 +48,28 @@ from base64 import b64encode, b64decode
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httputil import HTTPHeaders
 
+try:
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient
+except ImportError:
+    # Tornado 1.0 only ships the curl based client
+    SimpleAsyncHTTPClient = None
+
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    pycurl = None
+    CurlAsyncHTTPClient = None
+
+try:
+    # Python 2
+    _string_types = basestring
+except NameError:
+    # Python 3
+    _string_types = (str, bytes)
+
 log = logging.getLogger('trombi')
+slow_request_log = logging.getLogger('trombi.slow')
 
 try:
     import json
@@ -53,6 +77,7 @@ except ImportError:
     import simplejson as json
 
 import trombi.errors
+import trombi.tracing
 
 
 def from_uri(uri, fetch_args=None, io_loop=None, **kwargs):
@@ -142,11 +167,402 @@ def _error_response(response):
         return TrombiErrorResponse(response.code, content)
 
 
+def _parallel(tasks, concurrency, callback):
+    # Runs the functions in tasks, at most concurrency of them at a
+    # time. Each task is called with a callback taking the result of
+    # the task. When all the tasks are done, callback is called with
+    # the results in the order of the tasks.
+    results = [None] * len(tasks)
+    state = {'started': 0, 'finished': 0}
+
+    def _start_next():
+        index = state['started']
+        state['started'] += 1
+
+        def _done(result):
+            results[index] = result
+            state['finished'] += 1
+            if state['started'] < len(tasks):
+                _start_next()
+            elif state['finished'] == len(tasks):
+                callback(results)
+
+        tasks[index](_done)
+
+    if not tasks:
+        callback(results)
+        return
+
+    for i in range(min(max(concurrency, 1), len(tasks))):
+        _start_next()
+
+
+# The reasons CouchDB 2.x and 1.x give for a missing database
+_MISSING_DATABASE_REASONS = ('Database does not exist.', 'no_db_file')
+
+
+def _endpoint_missing(response):
+    # CouchDB versions lacking an endpoint either don't route it at
+    # all or treat it as a document id starting with an underscore
+    if response.code == 404:
+        # The endpoint may be there while the database is not
+        return (_error_response(response).msg not in
+                _MISSING_DATABASE_REASONS)
+    if response.code in (405, 501):
+        return True
+    if response.code == 400:
+        return 'reserved' in str(_error_response(response).msg)
+    return False
+
+
+# Database level endpoints with an operation name of their own
+_DATABASE_OPERATIONS = {
+    '_changes': 'changes',
+    '_bulk_docs': 'bulk_docs',
+    '_bulk_get': 'bulk_get',
+    '_all_docs': 'view',
+    '_revs_diff': 'revs_diff',
+    '_temp_view': 'view',
+    '_find': 'find',
+    '_index': 'index',
+    '_explain': 'find',
+    '_compact': 'compact',
+    '_view_cleanup': 'compact',
+    }
+
+_DOCUMENT_OPERATIONS = {
+    'GET': 'get',
+    'HEAD': 'get',
+    'PUT': 'set',
+    'POST': 'set',
+    'DELETE': 'delete',
+    'COPY': 'copy',
+    }
+
+RequestInfo = collections.namedtuple(
+    'RequestInfo', ['db', 'op', 'target', 'template'])
+
+
+def _request_info(path, method):
+    # Tells the database, type of operation, its target (a document,
+    # view or other name) and the URL template of a request. The
+    # template has the variable parts replaced, so that it can be
+    # used for grouping requests.
+    path = path.split('?', 1)[0]
+    parts = [part for part in path.split('/') if part]
+
+    if not parts:
+        return RequestInfo(None, 'server', None, '/')
+    if parts[0].startswith('_'):
+        # Server level endpoint, like _session or _active_tasks
+        return RequestInfo(
+            None, parts[0][1:], None, '/%s' % '/'.join(parts))
+
+    db = parts[0]
+    rest = parts[1:]
+    if not rest:
+        if method == 'POST':
+            return RequestInfo(db, 'set', None, '/{db}')
+        return RequestInfo(db, 'database', None, '/{db}')
+
+    if rest[0] == '_design' and len(rest) >= 4 and \
+            rest[2] in ('_view', '_list', '_show', '_update'):
+        op = rest[2][1:]
+        if op == 'list':
+            op = 'view'
+        target = '%s/%s' % (rest[1], rest[3])
+        return RequestInfo(
+            db, op, target, '/{db}/_design/{ddoc}/%s/{name}' % rest[2])
+    if rest[0] in _DATABASE_OPERATIONS:
+        return RequestInfo(
+            db, _DATABASE_OPERATIONS[rest[0]], rest[0],
+            '/{db}/%s' % '/'.join(rest))
+
+    # A document or its attachment. Design and local documents have
+    # the prefix as a part of their id.
+    if rest[0] in ('_design', '_local') and len(rest) > 1:
+        doc_id = '%s/%s' % (rest[0], rest[1])
+        prefix = '%s/' % rest[0]
+        rest = rest[2:]
+    else:
+        doc_id = rest[0]
+        prefix = ''
+        rest = rest[1:]
+    op = _DOCUMENT_OPERATIONS.get(method, method.lower())
+    if rest:
+        return RequestInfo(
+            db, 'attachment', doc_id, '/{db}/%s{docid}/{attachment}' % prefix)
+    return RequestInfo(db, op, doc_id, '/{db}/%s{docid}' % prefix)
+
+
+def _body_size(body):
+    if not body:
+        return 0
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    return len(body)
+
+
+# The two first bytes of any gzip stream
+_GZIP_MAGIC = b'\x1f\x8b'
+
+# zlib handles the gzip format when the window bits are offset by 16
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# The session cookie and its lifetime in the Set-Cookie header of
+# _session responses
+_AUTH_SESSION_RE = re.compile(r'AuthSession=([^;,\s]*)')
+_MAX_AGE_RE = re.compile(r'Max-Age=(\d+)', re.I)
+
+_COMPRESSION_KEYS = (
+    'compressed_requests',
+    'request_bytes',
+    'request_bytes_compressed',
+    'compress_time',
+    'compressed_responses',
+    'response_bytes',
+    'response_bytes_compressed',
+    'decompress_time',
+    )
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_body(body, threshold):
+    # Compresses a request body of at least threshold bytes. Returns
+    # the body and the compression stats, or None if the body was left
+    # as it is.
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    if threshold is None or len(body) < threshold:
+        return body, None
+
+    start = time.time()
+    compressed = _gzip(body)
+    return compressed, {
+        'compress_time': time.time() - start,
+        'compressed_requests': 1,
+        'request_bytes': len(body),
+        'request_bytes_compressed': len(compressed),
+        }
+
+
+def _encode_body(encode, gzip_threshold):
+    # Run in the executor, so that compressing a large body doesn't
+    # block the IOLoop either
+    return _gzip_body(encode(), gzip_threshold)
+
+
+def _gunzip_stream(streaming_callback, stats):
+    # Returns a streaming callback that decompresses the stream
+    # incrementally if it's gzip encoded, and a header callback to
+    # find that out
+    state = {'gzip': False, 'decompressor': None}
+
+    def _header(line):
+        name, sep, value = line.partition(':')
+        if (name.strip().lower() == 'content-encoding' and
+            value.strip().lower() == 'gzip'):
+            state['gzip'] = True
+
+    def _stream(chunk):
+        if state['gzip'] and state['decompressor'] is None:
+            if chunk[:2] == _GZIP_MAGIC:
+                state['decompressor'] = zlib.decompressobj(_GZIP_WBITS)
+                stats['compressed_responses'] = 1
+            else:
+                # The HTTP client decompressed the stream already
+                state['gzip'] = False
+
+        decompressor = state['decompressor']
+        if decompressor is not None:
+            start = time.time()
+            data = decompressor.decompress(chunk)
+            stats['decompress_time'] = (
+                stats.get('decompress_time', 0) + time.time() - start)
+            stats['response_bytes_compressed'] = (
+                stats.get('response_bytes_compressed', 0) + len(chunk))
+            stats['response_bytes'] = (
+                stats.get('response_bytes', 0) + len(data))
+            chunk = data
+
+        if chunk:
+            streaming_callback(chunk)
+
+    return _stream, _header
+
+
+def _decode_json(body):
+    # A module level function, so that it can be run in a process pool
+    return json.loads(body.decode('utf-8'))
+
+
+class _Response(object):
+    """
+    Wraps the response of the HTTP client. The body is decompressed if
+    it was gzip encoded and the statistics of the request are stored
+    in *stats*. Everything else is proxied to the original response.
+    """
+    def __init__(self, response, body, stats):
+        self._response = response
+        self.body = body
+        self.stats = stats
+        self._content = None
+        self._decoded = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def json(self):
+        # Decodes the body once and keeps track of the time spent
+        if not self._decoded:
+            start = time.time()
+            self._content = json.loads(self.body.decode('utf-8'))
+            self._decoded = True
+            self.stats['decode_time'] = time.time() - start
+        return self._content
+
+
+class _ErrorResponse(object):
+    """
+    Stands in for the response of a request that failed in trombi
+    instead of CouchDB. The body is the error in the format of CouchDB.
+    """
+    def __init__(self, code, reason):
+        self.code = code
+        self.body = json.dumps(
+            {'error': 'trombi', 'reason': reason}).encode('utf-8')
+        self.headers = HTTPHeaders()
+        self.stats = {}
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+if CurlAsyncHTTPClient is not None:
+    class _CurlAsyncHTTPClient(CurlAsyncHTTPClient):
+        # Counts the connections libcurl had to open to complete the
+        # transfers, which is how reused keep-alive connections are
+        # told apart from new ones.
+        new_connections = 0
+
+        def _finish(self, curl, *args, **kwargs):
+            self.new_connections += curl.getinfo(pycurl.NUM_CONNECTS)
+            super(_CurlAsyncHTTPClient, self)._finish(curl, *args, **kwargs)
+else:
+    _CurlAsyncHTTPClient = None
+
+
+class _ConnectionPool(object):
+    """
+    Keeps book of the requests going through the HTTP client and
+    limits the number of concurrent connections to the server.
+    Requests over the limit are queued here instead of the HTTP
+    client, so that the queue length can be observed.
+    """
+    # The window, in seconds, used for the new connection rate
+    rate_window = 10
+
+    def __init__(self, client, max_connections=None, keep_alive=True):
+        self.client = client
+        self.max_connections = max_connections
+        self.keep_alive = keep_alive and (
+            CurlAsyncHTTPClient is not None and
+            isinstance(client, CurlAsyncHTTPClient))
+        self.active = 0
+        self.queue = collections.deque()
+        self.requests = 0
+        self.new_connections = 0
+        # The largest number of concurrently used connections, which
+        # is what a keep-alive transport keeps open
+        self._size = 0
+        self._connects = collections.deque()
+        self._curl_connections = 0
+
+    def fetch(self, url, callback, on_start=None, **kwargs):
+        if self.max_connections and self.active >= self.max_connections:
+            self.queue.append((url, callback, on_start, kwargs))
+        else:
+            self._start(url, callback, on_start, kwargs)
+
+    def _start(self, url, callback, on_start, kwargs):
+        self.active += 1
+        self._size = max(self._size, self.active)
+        if on_start is not None:
+            on_start()
+
+        def _done(response):
+            self.active -= 1
+            self.requests += 1
+            self._count_connections()
+            if self.queue:
+                self._start(*self.queue.popleft())
+            callback(response)
+
+        self.client.fetch(url, _done, **kwargs)
+
+    def _count_connections(self):
+        if (_CurlAsyncHTTPClient is not None and
+            isinstance(self.client, _CurlAsyncHTTPClient)):
+            opened = self.client.new_connections - self._curl_connections
+            self._curl_connections = self.client.new_connections
+        else:
+            # Without a way to ask the client, assume that every
+            # request opened a connection of its own
+            opened = 1
+
+        if opened:
+            self.new_connections += opened
+            self._connects.append((time.time(), opened))
+
+    def stats(self):
+        threshold = time.time() - self.rate_window
+        while self._connects and self._connects[0][0] < threshold:
+            self._connects.popleft()
+        recent = sum(count for timestamp, count in self._connects)
+
+        if self.keep_alive:
+            idle = max(0, self._size - self.active)
+        else:
+            idle = 0
+
+        return TrombiDict({
+            'active': self.active,
+            'idle': idle,
+            'queued': len(self.queue),
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'new_connections_per_second': recent / float(self.rate_window),
+        })
+
+
 class Server(TrombiObject):
+    # The number of concurrent document requests used in place of
+    # _bulk_get, if the server does not support it
+    bulk_get_fallback_concurrency = 10
+
     def __init__(self, baseurl, fetch_args=None, io_loop=None,
-                 json_encoder=None, **client_args):
+                 json_encoder=None, transport=None, keep_alive=True,
+                 max_connections=None, pool_warm_size=0,
+                 gzip_responses=False, gzip_threshold=None,
+                 track_nested_changes=False, metrics=None, tracer=None,
+                 slow_request_threshold=None, slow_request_sample_rate=1.0,
+                 executor=None, decode_threshold=1024 * 1024,
+                 encode_threshold=1024 * 1024, encode_batch_threshold=1000,
+                 drop_attachment_data=False, view_read_policy='fresh',
+                 view_refresh_interval=60, info_cache_ttl=0,
+                 seq_poll_interval=5, session_auth=None,
+                 session_timeout=600, **client_args):
         self.error = False
         self.session_cookie = None
+        self.session_timeout = session_timeout
+        self._session_auth = session_auth
+        self._session_expires = 0
+        self._session_renew_at = 0
+        self._session_waiters = None
         self.baseurl = baseurl
         if self.baseurl[-1] == '/':
             self.baseurl = self.baseurl[:-1]
@@ -162,7 +578,114 @@ class Server(TrombiObject):
         # We can assign None to _json_encoder as the json (or
         # simplejson) then defaults to json.JSONEncoder
         self._json_encoder = json_encoder
-        self._client = AsyncHTTPClient(self.io_loop, **client_args)
+        self.track_nested_changes = track_nested_changes
+        self.drop_attachment_data = drop_attachment_data
+        self.view_read_policy = view_read_policy
+        self.view_refresh_interval = view_refresh_interval
+        self._view_refreshes = {}
+        self._compaction_scheduler = None
+        self.info_cache_ttl = info_cache_ttl
+        self.seq_poll_interval = seq_poll_interval
+        self._info_cache = {}
+        self._info_requests = {}
+        self._seq_watchers = {}
+        self._keep_alive = keep_alive
+        self._pool_warm_size = pool_warm_size
+        self._gzip_responses = gzip_responses
+        self._gzip_threshold = gzip_threshold
+        self._compression = dict.fromkeys(_COMPRESSION_KEYS, 0)
+        self.metrics = metrics
+        self.tracer = tracer
+        self.slow_request_threshold = slow_request_threshold
+        self.slow_request_sample_rate = slow_request_sample_rate
+        self.executor = executor
+        self.decode_threshold = decode_threshold
+        self.encode_threshold = encode_threshold
+        self.encode_batch_threshold = encode_batch_threshold
+        self._send_queue = collections.deque()
+        self._changes_hubs = {}
+        self._bulk_get_supported = True
+        self._dbs_info_supported = True
+        self._client = self._create_client(
+            transport, max_connections, client_args)
+        self._pool = _ConnectionPool(
+            self._client, max_connections, keep_alive)
+
+        if metrics is not None:
+            metrics.track_server(self)
+
+        if pool_warm_size:
+            self.io_loop.add_callback(self.warm_pool)
+
+    def _create_client(self, transport, max_connections, client_args):
+        if transport is None:
+            return AsyncHTTPClient(self.io_loop, **client_args)
+        elif transport == 'simple':
+            if SimpleAsyncHTTPClient is None:
+                raise ValueError(
+                    'The simple transport is not supported by this '
+                    'Tornado version')
+            client_class = SimpleAsyncHTTPClient
+        elif transport == 'curl':
+            if _CurlAsyncHTTPClient is None:
+                raise ValueError('The curl transport requires pycurl')
+            client_class = _CurlAsyncHTTPClient
+        else:
+            raise ValueError('Unknown transport: %r' % transport)
+
+        if max_connections:
+            client_args.setdefault('max_clients', max_connections)
+
+        # Force a client instance of our own, otherwise Tornado would
+        # share one between all the servers on the same IOLoop
+        return client_class(self.io_loop, force_instance=True, **client_args)
+
+    def pool_stats(self):
+        return self._pool.stats()
+
+    def compression_stats(self):
+        stats = TrombiDict(self._compression)
+        stats['request_ratio'] = None
+        stats['response_ratio'] = None
+        if stats['request_bytes']:
+            stats['request_ratio'] = (
+                stats['request_bytes_compressed'] /
+                float(stats['request_bytes']))
+        if stats['response_bytes']:
+            stats['response_ratio'] = (
+                stats['response_bytes_compressed'] /
+                float(stats['response_bytes']))
+        return stats
+
+    def warm_pool(self, callback=None, size=None):
+        if size is None:
+            size = self._pool_warm_size
+        if self._pool.max_connections:
+            size = min(size, self._pool.max_connections)
+
+        remaining = [size]
+
+        def _warmed(response):
+            remaining[0] -= 1
+            if remaining[0] == 0 and callback is not None:
+                callback(self.pool_stats())
+
+        if size <= 0:
+            if callback is not None:
+                callback(self.pool_stats())
+            return
+
+        # Open the connections by issuing concurrent requests to the
+        # server root, the keep-alive transport keeps them open
+        for i in range(size):
+            self._fetch('%s/' % self.baseurl, _warmed)
+
+    def _request_info(self, url, method):
+        if url.startswith(self.baseurl):
+            path = url[len(self.baseurl):]
+        else:
+            path = '/' + url.split('://', 1)[-1].partition('/')[2]
+        return _request_info(path, method)
 
     def _invalid_db_name(self, name):
         return TrombiErrorResponse(
@@ -170,24 +693,365 @@ class Server(TrombiObject):
             'Invalid database name: %r' % name,
             )
 
-    def _fetch(self, *args, **kwargs):
+    def _fetch(self, url, callback, **kwargs):
         # This is just a convenince wrapper for _client.fetch
 
+        # The body can be given as a function that builds it, which is
+        # run in the executor if asked to. Requests are sent in the
+        # order they were made, so the later ones wait for it.
+        encode = kwargs.pop('encode', None)
+        offload = kwargs.pop('offload', False) and self.executor is not None
+        if encode is None and not self._send_queue:
+            self._send(url, callback, kwargs)
+            return
+
+        entry = [url, callback, kwargs, not offload]
+        if encode is not None and not offload:
+            kwargs['body'] = encode()
+        self._send_queue.append(entry)
+        if offload:
+            if kwargs.pop('compress', False):
+                gzip_threshold = self._gzip_threshold
+            else:
+                gzip_threshold = None
+            future = self.executor.submit(
+                _encode_body, encode, gzip_threshold)
+
+            def _encoded():
+                try:
+                    kwargs['body'], compressed = future.result()
+                    if compressed is not None:
+                        kwargs['compressed'] = compressed
+                except Exception:
+                    log.debug('Encoding in the executor failed',
+                              exc_info=True)
+                    # Don't hold up the other requests
+                    self._send_queue.remove(entry)
+                    self._flush_send_queue()
+                    callback(_ErrorResponse(
+                        trombi.errors.ENCODING_FAILED,
+                        'Unable to encode the request body: %s' %
+                        (future.exception(),)))
+                    return
+
+                entry[3] = True
+                self._flush_send_queue()
+
+            # The future is done in another thread, get back to the
+            # IOLoop. The request is sent with the span active now.
+            _encoded = trombi.tracing.wrap(_encoded)
+            future.add_done_callback(
+                lambda future: self.io_loop.add_callback(_encoded))
+        else:
+            self._flush_send_queue()
+
+    def _flush_send_queue(self):
+        while self._send_queue and self._send_queue[0][3]:
+            url, callback, kwargs, ready = self._send_queue.popleft()
+            self._send(url, callback, kwargs)
+
+    def _send(self, url, callback, kwargs):
+        # Login requests are sent without the session cookie
+        use_session = kwargs.pop('session', True)
+        if use_session and self._session_auth is not None:
+            self._send_in_session(url, callback, kwargs)
+        else:
+            self._send_request(url, callback, kwargs, use_session)
+
+    def _send_in_session(self, url, callback, kwargs, retried=False):
+        now = time.time()
+        if self.session_cookie is None or now >= self._session_expires:
+            # Wait for a new session
+            def _logged_in(error):
+                if error is not None:
+                    callback(error)
+                else:
+                    self._send_in_session(url, callback, kwargs, retried)
+
+            self._renew_session(_logged_in)
+            return
+
+        if now >= self._session_renew_at:
+            # The cookie is still good while the session is renewed
+            self._renew_session(lambda error: None)
+
+        cookie = self.session_cookie
+        if retried or 'streaming_callback' in kwargs:
+            self._send_request(url, callback, dict(kwargs), True)
+            return
+
+        def _really_callback(response):
+            if response.code == 401:
+                # The session has expired on the server, log in again
+                # unless some other request has done it already
+                if self.session_cookie == cookie:
+                    self.session_cookie = None
+                self._send_in_session(url, callback, kwargs, True)
+            else:
+                callback(response)
+
+        self._send_request(url, _really_callback, dict(kwargs), True)
+
+    def _renew_session(self, callback):
+        # Requests needing a session wait for a single login
+        if self._session_waiters is not None:
+            self._session_waiters.append(callback)
+            return
+
+        self._session_waiters = [callback]
+
+        def _logged_in(response):
+            waiters = self._session_waiters
+            self._session_waiters = None
+            if response.code in (200, 302):
+                response = None
+            else:
+                # Don't retry on every request while the old session
+                # lasts, try again halfway to its expiry
+                now = time.time()
+                self._session_renew_at = (
+                    now + max(0, self._session_expires - now) / 2)
+            for waiter in waiters:
+                waiter(response)
+
+        username, password = self._session_auth
+        self._login(username, password, _logged_in)
+
+    def _set_session(self, set_cookie):
+        match = _AUTH_SESSION_RE.search(set_cookie or '')
+        if match is None or not match.group(1):
+            return False
+
+        timeout = self.session_timeout
+        max_age = _MAX_AGE_RE.search(set_cookie)
+        if max_age is not None:
+            timeout = int(max_age.group(1))
+
+        now = time.time()
+        self.session_cookie = 'AuthSession=%s' % match.group(1)
+        self._session_expires = now + timeout
+        # Renew when 90% of the lifetime has passed
+        self._session_renew_at = now + timeout * 0.9
+        return True
+
+    def _send_request(self, url, callback, kwargs, use_session):
+        # Request bodies are only compressed when asked for. Bodies
+        # encoded in the executor are compressed there already.
+        compress = kwargs.pop('compress', False)
+        compressed = kwargs.pop('compressed', None)
+
         # Set default arguments for a fetch
         fetch_args = {
             'headers': HTTPHeaders({'Content-Type': 'application/json'})
         }
         fetch_args.update(self._fetch_args)
         fetch_args.update(kwargs)
-
-        if self.session_cookie:
-            fetch_args['X-CouchDB-WWW-Authenticate': 'Cookie']
-            if 'Cookie' in fetch_args:
-                fetch_args['Cookie'] += '; %s' % self.session_cookie
+        # Copy the headers, they might be shared between requests
+        fetch_args['headers'] = HTTPHeaders(fetch_args['headers'])
+
+        if not self._keep_alive:
+            fetch_args['headers']['Connection'] = 'close'
+
+        stats = {}
+
+        if compressed is not None:
+            stats.update(compressed)
+            fetch_args['headers']['Content-Encoding'] = 'gzip'
+        elif compress and self._gzip_threshold is not None:
+            self._compress_body(fetch_args, stats)
+
+        streaming = 'streaming_callback' in fetch_args
+        if self._gzip_responses:
+            # Decompress here instead of the HTTP client to be able to
+            # tell how much the compression saved
+            fetch_args['headers']['Accept-Encoding'] = 'gzip'
+            fetch_args['use_gzip'] = False
+            if streaming:
+                (fetch_args['streaming_callback'],
+                 fetch_args['header_callback']) = _gunzip_stream(
+                    fetch_args['streaming_callback'], stats)
+
+        metrics = self.metrics
+        tracer = self.tracer
+        # Streaming and long polling requests are slow by design
+        slow_log = (
+            self.slow_request_threshold is not None and not streaming and
+            'feed=longpoll' not in url and (
+                self.slow_request_sample_rate >= 1 or
+                random.random() < self.slow_request_sample_rate))
+        observed = metrics is not None or tracer is not None or slow_log
+        on_start = None
+        if observed:
+            info = self._request_info(url, fetch_args.get('method', 'GET'))
+            timing = {'start': time.time(), 'streamed_bytes': 0}
+            if streaming:
+                stream = fetch_args['streaming_callback']
+
+                def _count_stream(chunk):
+                    timing['streamed_bytes'] += len(chunk)
+                    stream(chunk)
+
+                fetch_args['streaming_callback'] = _count_stream
+
+            def on_start():
+                # The request got a connection and is sent
+                timing['sent'] = time.time()
+                if tracer is not None:
+                    span.log_event('sent', timing['sent'])
+
+        if metrics is not None:
+            metrics.request_started(info.op, info.db)
+        if tracer is not None:
+            span = tracer.start_span(
+                'couchdb.%s' % info.op,
+                parent=trombi.tracing.active_span(),
+                tags={
+                    'db': info.db,
+                    'op': info.op,
+                    'target': info.target,
+                    'http.method': fetch_args.get('method', 'GET'),
+                    'http.url': info.template,
+                    })
+
+        if use_session and self.session_cookie:
+            headers = fetch_args['headers']
+            headers['X-CouchDB-WWW-Authenticate'] = 'Cookie'
+            if 'Cookie' in headers:
+                headers['Cookie'] += '; %s' % self.session_cookie
+            else:
+                headers['Cookie'] = self.session_cookie
+
+        def _response_callback(response):
+            if use_session and self.session_cookie:
+                # CouchDB hands out a fresh cookie when the session
+                # gets old
+                self._set_session(response.headers.get('Set-Cookie'))
+
+            body = response.body
+            if (self._gzip_responses and not streaming and body and
+                response.headers.get('Content-Encoding') == 'gzip' and
+                body[:2] == _GZIP_MAGIC):
+                start = time.time()
+                body = zlib.decompress(body, _GZIP_WBITS)
+                stats['decompress_time'] = time.time() - start
+                stats['compressed_responses'] = 1
+                stats['response_bytes_compressed'] = len(response.body)
+                stats['response_bytes'] = len(body)
+
+            if observed:
+                timing['response'] = time.time()
+                timing['sent'] = timing.get('sent', timing['start'])
+                # Our pool is usually not the only queue, count the
+                # time spent waiting for max_clients of the HTTP client
+                # too when it tells it
+                time_info = getattr(response, 'time_info', None) or {}
+                if time_info.get('queue'):
+                    timing['sent'] = min(timing['sent'] + time_info['queue'],
+                                         timing['response'])
+                timing['request_bytes'] = _body_size(fetch_args.get('body'))
+                timing['response_bytes'] = (
+                    len(response.body or b'') + timing['streamed_bytes'])
+            if metrics is not None:
+                metrics.request_finished(
+                    info.op, info.db, response.code,
+                    timing['response'] - timing['start'],
+                    timing['request_bytes'], timing['response_bytes'])
+
+            for key, value in stats.items():
+                self._compression[key] += value
+
+            response = _Response(response, body, stats)
+            if (self.executor is not None and not streaming and body and
+                len(body) >= self.decode_threshold and
+                body[:1] in (b'{', b'[')):
+                self._decode_in_executor(response, _run_callback)
             else:
-                fetch_args['Cookie'] = self.sesison_cookie
+                _run_callback(response)
 
-        self._client.fetch(*args, **fetch_args)
+        def _run_callback(response):
+            if tracer is None and not slow_log:
+                callback(response)
+                return
+
+            if tracer is not None:
+                span.log_event('response', timing['response'])
+                span.set_tag('http.status_code', response.code)
+                span.set_tag('request_bytes', timing['request_bytes'])
+                span.set_tag('response_bytes', timing['response_bytes'])
+                span.set_tag('queue_time', timing['sent'] - timing['start'])
+                span.set_tag(
+                    'network_time', timing['response'] - timing['sent'])
+                if response.code >= 400:
+                    span.set_tag('error', True)
+            started = time.time()
+            try:
+                if tracer is not None:
+                    # Requests made by the callback become children of
+                    # this span
+                    with trombi.tracing.activate(span):
+                        callback(response)
+                else:
+                    callback(response)
+            finally:
+                finished = time.time()
+                callback_time = (
+                    finished - started - stats.get('decode_time', 0.0))
+                # Decoding in the executor is timed from the arrival of
+                # the response to the resuming of the callback
+                decode_time = (stats.get('decode_time', 0.0) +
+                               stats.get('executor_decode_time', 0.0))
+                if tracer is not None:
+                    span.set_tag('decode_time', decode_time)
+                    span.set_tag('callback_time', callback_time)
+                    span.finish()
+                if slow_log and (finished - timing['start'] >=
+                                 self.slow_request_threshold):
+                    slow_request_log.warning(
+                        'Slow request: %s %s (%s) status %s, %.3fs: '
+                        'queued %.3fs, network %.3fs, decode %.3fs, '
+                        'callback %.3fs, %d bytes sent, %d bytes received',
+                        fetch_args.get('method', 'GET'), info.template,
+                        info.db or '-', response.code,
+                        finished - timing['start'],
+                        timing['sent'] - timing['start'],
+                        timing['response'] - timing['sent'],
+                        decode_time, callback_time,
+                        timing['request_bytes'], timing['response_bytes'])
+
+        self._pool.fetch(
+            url, _response_callback, on_start=on_start, **fetch_args)
+
+    def _decode_in_executor(self, response, callback):
+        submitted = time.time()
+        future = self.executor.submit(_decode_json, response.body)
+
+        def _resume():
+            try:
+                response._content = future.result()
+                response._decoded = True
+            except Exception:
+                # Leave the body to be decoded by the callback, which
+                # also handles invalid JSON
+                log.debug('Decoding in the executor failed', exc_info=True)
+            response.stats['executor_decode_time'] = time.time() - submitted
+            callback(response)
+
+        # The future is done in another thread, get back to the IOLoop
+        _resume = trombi.tracing.wrap(_resume)
+        future.add_done_callback(
+            lambda future: self.io_loop.add_callback(_resume))
+
+    def _compress_body(self, fetch_args, stats):
+        body = fetch_args.get('body')
+        if not body:
+            return
+        body, compressed = _gzip_body(body, self._gzip_threshold)
+        if compressed is None:
+            return
+
+        stats.update(compressed)
+        fetch_args['body'] = body
+        fetch_args['headers']['Content-Encoding'] = 'gzip'
 
     def create(self, name, callback):
         if not VALID_DB_NAME.match(name):
@@ -259,8 +1123,7 @@ class Server(TrombiObject):
     def list(self, callback):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(Database(self, x) for x in json.loads(body))
+                callback(Database(self, x) for x in response.json())
             else:
                 callback(_error_response(response))
 
@@ -318,37 +1181,190 @@ class Server(TrombiObject):
         def _really_callback(response):
             if response.code == 200:
                 self.session_cookie = None
-                callback(TrombiResult(json.loads(response.body)))
+                callback(TrombiResult(response.json()))
             else:
                 callback(_error_response(response))
 
         url = '%s/%s' % (self.baseurl, '_session')
-        self._client.fetch(url, _really_callback, method='DELETE')
+        self._fetch(url, _really_callback, method='DELETE', session=False)
 
     def login(self, username, password, callback):
         def _really_callback(response):
             if response.code in (200, 302):
-                self.session_cookie = response.headers['Set-Cookie']
-                response_body = json.loads(response.body)
-                callback(TrombiResult(response_body))
+                callback(TrombiResult(response.json()))
             else:
                 callback(_error_response(response))
 
-        body = urllib.urlencode({'name': username, 'password': password})
-        url = '%s/%s' % (self.baseurl, '_session')
+        self._login(username, password, _really_callback)
 
-        self._client.fetch(url, _really_callback, method='POST', body=body)
+    def _login(self, username, password, callback):
+        def _really_callback(response):
+            if (response.code in (200, 302) and
+                not self._set_session(response.headers.get('Set-Cookie'))):
+                response = _ErrorResponse(
+                    trombi.errors.NO_SESSION_COOKIE,
+                    'No session cookie in the login response')
+            callback(response)
+
+        url = '%s/%s' % (self.baseurl, '_session')
+        self._fetch(
+            url,
+            _really_callback,
+            method='POST',
+            body=json.dumps({'name': username, 'password': password}),
+            session=False,
+            )
 
     def session(self, callback):
         def _really_callback(response):
             if response.code == 200:
-                body = json.loads(response.body)
-                callback(TrombiResult(body))
+                callback(TrombiResult(response.json()))
             else:
                 callback(_error_response(response))
 
         url = '%s/%s' % (self.baseurl, '_session')
-        self._client.fetch(url, _really_callback)
+        self._fetch(url, _really_callback)
+
+    def collect_info(self, callback, names=None, concurrency=10,
+                     batch_size=100, info_callback=None):
+        started = time.time()
+        summary = TrombiDict(
+            databases=0, doc_count=0, doc_del_count=0, disk_size=0,
+            data_size=0, errors={})
+
+        def _got_info(name, info):
+            if info.error:
+                summary['errors'][name] = info.msg
+            else:
+                disk_size, data_size = _database_sizes(info)
+                summary['databases'] += 1
+                summary['doc_count'] += info.get('doc_count', 0)
+                summary['doc_del_count'] += info.get('doc_del_count', 0)
+                summary['disk_size'] += disk_size or 0
+                summary['data_size'] += data_size or 0
+            if info_callback is not None:
+                info_callback(name, info)
+
+        def _task(batch):
+            def _run(done):
+                self._dbs_info(batch, _got_info, done)
+            return _run
+
+        def _done(results):
+            summary['elapsed'] = time.time() - started
+            callback(summary)
+
+        def _got_names(names):
+            tasks = [
+                _task(names[i:i + batch_size])
+                for i in range(0, len(names), batch_size)]
+            _parallel(tasks, concurrency, _done)
+
+        if names is not None:
+            _got_names(list(names))
+            return
+
+        def _really_callback(response):
+            if response.code == 200:
+                _got_names(response.json())
+            else:
+                callback(_error_response(response))
+
+        self._fetch('%s/_all_dbs' % self.baseurl, _really_callback)
+
+    def _dbs_info(self, names, info_callback, callback):
+        if not self._dbs_info_supported:
+            self._dbs_info_fallback(names, info_callback, callback)
+            return
+
+        def _really_callback(response):
+            if response.code == 200:
+                for item in response.json():
+                    if 'info' in item:
+                        info = TrombiDict(item['info'])
+                    else:
+                        info = TrombiErrorResponse(
+                            trombi.errors.NOT_FOUND,
+                            item.get('error', 'not_found'))
+                    info_callback(item['key'], info)
+                callback(None)
+            elif response.code in (400, 404) or _endpoint_missing(response):
+                # Older CouchDB, fetch the info of one database at a
+                # time. They take _dbs_info for a database name, so
+                # there is no database to be missing here.
+                self._dbs_info_supported = False
+                self._dbs_info_fallback(names, info_callback, callback)
+            else:
+                error = _error_response(response)
+                for name in names:
+                    info_callback(name, error)
+                callback(None)
+
+        self._fetch(
+            '%s/_dbs_info' % self.baseurl,
+            _really_callback,
+            method='POST',
+            body=json.dumps({'keys': names}),
+            )
+
+    def _dbs_info_fallback(self, names, info_callback, callback):
+        def _task(name):
+            def _run(done):
+                def _really_callback(info):
+                    info_callback(name, info)
+                    done(None)
+
+                Database(self, name).info(_really_callback)
+            return _run
+
+        # The batches are run concurrently already
+        _parallel([_task(name) for name in names], 1,
+                  lambda results: callback(None))
+
+    def compaction_scheduler(self, **kw):
+        if self._compaction_scheduler is None:
+            self._compaction_scheduler = CompactionScheduler(self, **kw)
+        elif kw:
+            raise ValueError('The compaction scheduler is already created')
+        return self._compaction_scheduler
+
+    def active_tasks(self, callback):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(TrombiResult(response.json()))
+            else:
+                callback(_error_response(response))
+
+        self._fetch('%s/_active_tasks' % self.baseurl, _really_callback)
+
+
+def _task_database(task):
+    # CouchDB 2.0 and newer run the tasks per shard, and report the
+    # shard, e.g. shards/00000000-1fffffff/mydb.1500000000
+    database = task.get('database', '')
+    if database.startswith('shards/'):
+        database = database.split('/', 2)[-1].rsplit('.', 1)[0]
+    return database
+
+
+def _task_progress(tasks):
+    # Combines the progress of the tasks of one database or index
+    total = sum(task.get('total_changes', 0) for task in tasks)
+    if total:
+        done = sum(task.get('changes_done', 0) for task in tasks)
+        return min(100, 100 * done // total)
+    progress = [task['progress'] for task in tasks if 'progress' in task]
+    if progress:
+        return sum(progress) // len(progress)
+    return 0
+
+
+def _database_sizes(info):
+    # Returns the size of the database file and of the live data in
+    # it. CouchDB 2.0 reports the sizes in a sizes object.
+    sizes = info.get('sizes', {})
+    return (sizes.get('file', info.get('disk_size')),
+            sizes.get('active', info.get('data_size')))
 
 
 class Database(TrombiObject):
@@ -366,16 +1382,84 @@ class Database(TrombiObject):
             url = '%s/%s' % (self.baseurl, url)
         return self.server._fetch(url, *args, **kwargs)
 
-    def info(self, callback):
+    def info(self, callback, max_age=None):
+        if max_age is None:
+            max_age = self.server.info_cache_ttl
+        cache = self.server._info_cache
+        cached = cache.get(self.name)
+        if cached is not None and time.time() - cached[0] < max_age:
+            self.server.io_loop.add_callback(trombi.tracing.wrap(
+                functools.partial(callback, copy.deepcopy(cached[1]))))
+            return
+
+        # With caching on, share the request with the callers waiting
+        # for it already
+        share = max_age > 0
+        waiting = self.server._info_requests.get(self.name)
+        if share and waiting is not None:
+            waiting.append(callback)
+            return
+        waiting = [callback]
+        if share:
+            self.server._info_requests[self.name] = waiting
+
         def _really_callback(response):
+            if self.server._info_requests.get(self.name) is waiting:
+                del self.server._info_requests[self.name]
             if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(TrombiDict(json.loads(body)))
+                result = TrombiDict(response.json())
+                cache[self.name] = (time.time(), result)
             else:
-                callback(_error_response(response))
+                result = _error_response(response)
+            for callback in waiting:
+                # Every caller gets a copy of its own to modify
+                if result.error:
+                    callback(result)
+                else:
+                    callback(copy.deepcopy(result))
 
         self._fetch('', _really_callback)
 
+    def _post_accepted(self, url, callback):
+        # Compaction requests respond 202 Accepted and run on the
+        # background
+        def _really_callback(response):
+            if response.code == 202:
+                callback(TrombiObject())
+            else:
+                callback(_error_response(response))
+
+        self._fetch(url, _really_callback, method='POST', body='')
+
+    def compact(self, callback):
+        self._post_accepted('_compact', callback)
+
+    def compact_views(self, design_doc, callback):
+        self._post_accepted('_compact/%s' % design_doc, callback)
+
+    def view_cleanup(self, callback):
+        self._post_accepted('_view_cleanup', callback)
+
+    def view_info(self, design_doc, callback):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(TrombiDict(response.json()))
+            else:
+                callback(_error_response(response))
+
+        self._fetch('_design/%s/_info' % design_doc, _really_callback)
+
+    def design_docs(self, callback):
+        def _really_callback(result):
+            if result.error:
+                callback(result)
+            else:
+                callback(TrombiResult([
+                    row['id'][len('_design/'):] for row in result]))
+
+        self.view(None, '_all_docs', _really_callback,
+                  startkey='_design/', endkey='_design0')
+
     def set(self, *args, **kwargs):
         cb = kwargs.pop('callback', None)
         if cb:
@@ -389,26 +1473,32 @@ class Database(TrombiObject):
             raise TypeError(
                 'Database.set takes at most 2 non-keyword arguments.')
 
-        if kwargs:
-            if list(kwargs.keys()) != ['attachments']:
-                if len(kwargs) > 1:
-                    raise TypeError(
-                        '%s are invalid keyword arguments for this function') %(
-                        (', '.join(kwargs.keys())))
-                else:
-                    raise TypeError(
-                        '%s is invalid keyword argument for this function' % (
-                            list(kwargs.keys())[0]))
+        invalid = [x for x in kwargs
+                   if x not in ('attachments', 'batch', 'skip_clean')]
+        if len(invalid) > 1:
+            raise TypeError(
+                '%s are invalid keyword arguments for this function' % (
+                    ', '.join(invalid)))
+        elif invalid:
+            raise TypeError(
+                '%s is invalid keyword argument for this function' % (
+                    invalid[0]))
 
-            attachments = kwargs['attachments']
-        else:
-            attachments = {}
+        attachments = kwargs.get('attachments', {})
+        batch = kwargs.get('batch', False)
+        skip_clean = kwargs.get('skip_clean', False)
 
         if isinstance(data, Document):
             doc = data
         else:
             doc = Document(self, data)
 
+        if skip_clean and not attachments and not doc.dirty:
+            # Nothing to save
+            self.server.io_loop.add_callback(
+                trombi.tracing.wrap(functools.partial(callback, doc)))
+            return
+
         if doc_id is None and doc.id is not None and doc.rev is not None:
             # Update the existing document
             doc_id = doc.id
@@ -420,29 +1510,66 @@ class Database(TrombiObject):
             url = ''
             method = 'POST'
 
-        for name, attachment in attachments.items():
-            content_type, attachment_data = attachment
-            if content_type is None:
-                content_type = 'text/plain'
-            doc.attachments[name] = {
-                'content_type': content_type,
-                'data': b64encode(attachment_data).decode('utf-8'),
-                }
+        if batch:
+            # CouchDB accepts the document to memory and commits it
+            # later, responding with 202 Accepted
+            url = '%s?batch=ok' % url
+
+        raw = doc.raw()
+        encoded = {}
+
+        def _encode():
+            # Runs in the executor for large attachments, so the
+            # document itself is not touched here
+            for name, attachment in attachments.items():
+                content_type, attachment_data = attachment
+                if content_type is None:
+                    content_type = 'text/plain'
+                encoded[name] = {
+                    'content_type': content_type,
+                    'data': b64encode(attachment_data).decode('utf-8'),
+                    }
+            if encoded:
+                raw['_attachments'] = dict(raw.get('_attachments', {}))
+                raw['_attachments'].update(encoded)
+            return json.dumps(raw, cls=self._json_encoder)
+
+        attachment_size = sum(
+            len(attachment_data)
+            for content_type, attachment_data in attachments.values())
 
         def _really_callback(response):
+            doc.attachments.update(encoded)
+            doc._prune_decoded_attachments()
+            content = None
             try:
                 # If the connection to the server is malfunctioning,
                 # ie. the simplehttpclient returns 599 and no body,
                 # don't set the content as the response.code will not
                 # be 201 at that point either
                 if response.body is not None:
-                    content = json.loads(response.body.decode('utf-8'))
+                    content = response.json()
             except ValueError:
                 content = response.body
 
             if response.code == 201:
                 doc.id = content['id']
                 doc.rev = content['rev']
+                doc.mark_clean()
+                callback(doc)
+            elif response.code == 202 and batch:
+                # No revision is known before the commit, and the old
+                # one would only make the next update conflict
+                if isinstance(content, dict) and 'id' in content:
+                    doc.id = content['id']
+                elif doc_id is not None:
+                    doc.id = doc_id
+                else:
+                    callback(TrombiErrorResponse(
+                        trombi.errors.SERVER_ERROR,
+                        'Invalid response from CouchDB: %r' % (content,)))
+                    return
+                doc.rev = None
                 callback(doc)
             else:
                 callback(_error_response(response))
@@ -451,13 +1578,15 @@ class Database(TrombiObject):
             url,
             _really_callback,
             method=method,
-            body=json.dumps(doc.raw(), cls=self._json_encoder),
+            encode=_encode,
+            offload=attachment_size >= self.server.encode_threshold,
+            compress=True,
         )
 
     def get(self, doc_id, callback, attachments=False):
         def _really_callback(response):
             if response.code == 200:
-                data = json.loads(response.body.decode('utf-8'))
+                data = response.json()
                 doc = Document(self, data)
                 callback(doc)
             elif response.code == 404:
@@ -501,28 +1630,46 @@ class Database(TrombiObject):
             _really_callback,
             )
 
-    def view(self, design_doc, viewname, callback, **kwargs):
+    def view(self, design_doc, viewname, callback, read_policy=None,
+             **kwargs):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
                 callback(
-                    ViewResult(json.loads(body), db=self)
+                    ViewResult(response.json(), db=self)
                     )
             else:
                 callback(_error_response(response))
 
+        if read_policy is None:
+            read_policy = self.server.view_read_policy
+        if read_policy not in ('fresh', 'stale'):
+            raise ValueError('Unknown read policy: %r' % read_policy)
+
         if not design_doc and viewname == '_all_docs':
             url = '_all_docs'
         else:
             url = '_design/%s/_view/%s' % (design_doc, viewname)
+            if read_policy == 'stale' and 'stale' not in kwargs:
+                kwargs['stale'] = self._stale_read(design_doc, viewname)
 
         # We need to pop keys before constructing the url to avoid it
         # ending up twice in the request, both in the body and as a
         # query parameter.
         keys = kwargs.pop('keys', None)
 
+        # CouchDB takes these as plain strings instead of JSON, other
+        # values like update=false are JSON encoded as usual
+        plain = dict(
+            (key, kwargs.pop(key)) for key in ('stale', 'update')
+            if isinstance(kwargs.get(key), _string_types))
+
+        query = []
         if kwargs:
-            url = '%s?%s' % (url, _jsonize_params(kwargs))
+            query.append(_jsonize_params(kwargs))
+        if plain:
+            query.append(urlencode(plain))
+        if query:
+            url = '%s?%s' % (url, '&'.join(query))
 
         if keys is not None:
             self._fetch(url, _really_callback,
@@ -532,6 +1679,320 @@ class Database(TrombiObject):
         else:
             self._fetch(url, _really_callback)
 
+    def _stale_read(self, design_doc, viewname):
+        # Answer from the index as it is. Once per interval, also ask
+        # CouchDB to update the index after answering.
+        key = (self.name, design_doc, viewname)
+        refreshes = self.server._view_refreshes
+        now = time.time()
+        if now - refreshes.get(key, 0) >= self.server.view_refresh_interval:
+            refreshes[key] = now
+            return 'update_after'
+        return 'ok'
+
+    def warm_views(self, design_docs, callback, poll_interval=1,
+                   progress_callback=None):
+        if isinstance(design_docs, _string_types):
+            design_docs = [design_docs]
+        design_docs = list(design_docs)
+        progress = TrombiDict((name, 0) for name in design_docs)
+        state = {'failed': False}
+
+        def _fail(error):
+            if not state['failed']:
+                state['failed'] = True
+                callback(error)
+
+        # All the views of a design document share one index, so it's
+        # enough to query one of them
+        def _start(name):
+            def _got_design_doc(doc):
+                if doc is None:
+                    _fail(TrombiErrorResponse(
+                        trombi.errors.NOT_FOUND,
+                        'Design document not found: %s' % name))
+                elif doc.error:
+                    _fail(doc)
+                elif not doc.get('views'):
+                    # Nothing to build
+                    _done(name)
+                else:
+                    view = sorted(doc['views'])[0]
+                    # Ask CouchDB to update the index after answering,
+                    # so that the request returns immediately
+                    self._fetch(
+                        '_design/%s/_view/%s?limit=0&stale=update_after' % (
+                            name, view),
+                        lambda response: _started(name, view, response))
+
+            self.get('_design/%s' % name, _got_design_doc)
+
+        def _started(name, view, response):
+            if response.code != 200:
+                _fail(_error_response(response))
+                return
+            _poll(name, view)
+
+        def _poll(name, view):
+            def _got_tasks(tasks):
+                if state['failed']:
+                    return
+                if tasks.error:
+                    _fail(tasks)
+                    return
+                indexers = [
+                    task for task in tasks.content
+                    if task.get('type') == 'indexer' and
+                    _task_database(task) == self.name and
+                    task.get('design_document') == '_design/%s' % name]
+                if indexers:
+                    progress[name] = _task_progress(indexers)
+                    if progress_callback is not None:
+                        progress_callback(progress)
+                    _schedule(name, view)
+                else:
+                    _check_fresh(name, view)
+
+            self.server.active_tasks(_got_tasks)
+
+        def _schedule(name, view):
+            self.server.io_loop.add_timeout(
+                time.time() + poll_interval,
+                trombi.tracing.wrap(lambda: _poll(name, view)))
+
+        def _check_fresh(name, view):
+            # The indexer may not have started yet or it's done. An
+            # up to date index answers immediately.
+            def _checked(response):
+                if state['failed']:
+                    return
+                if response.code == 200:
+                    _done(name)
+                else:
+                    # Probably timed out waiting for the index, keep
+                    # polling
+                    _schedule(name, view)
+
+            self._fetch(
+                '_design/%s/_view/%s?limit=0' % (name, view), _checked)
+
+        def _done(name):
+            progress[name] = 100
+            if progress_callback is not None:
+                progress_callback(progress)
+            if all(value == 100 for value in progress.values()):
+                callback(progress)
+
+        if not design_docs:
+            callback(progress)
+            return
+
+        for name in design_docs:
+            _start(name)
+
+    def view_many(self, design_doc, viewname, keys, callback,
+                  chunk_size=500, concurrency=4, **kwargs):
+        def _task(chunk):
+            def _run(done):
+                self.view(design_doc, viewname, done, keys=chunk, **kwargs)
+            return _run
+
+        def _done(results):
+            rows = []
+            for result in results:
+                if result.error:
+                    callback(result)
+                    return
+                rows.extend(result._rows)
+
+            # Mark the keys that had no rows
+            found = set(json.dumps(row.get('key'), sort_keys=True)
+                        for row in rows)
+            merged = ViewResult({
+                'rows': rows,
+                'total_rows': results[0].total_rows if results else 0,
+                }, db=self)
+            merged.missing = [key for key in keys
+                              if json.dumps(key, sort_keys=True) not in found]
+            callback(merged)
+
+        keys = list(keys)
+        chunks = [keys[i:i + chunk_size]
+                  for i in range(0, len(keys), chunk_size)]
+        _parallel([_task(chunk) for chunk in chunks], concurrency, _done)
+
+    def get_many(self, doc_ids, callback, chunk_size=500, concurrency=4):
+        def _really_callback(result):
+            if result.error:
+                callback(result)
+                return
+
+            # _all_docs returns a row for every key, in order. Missing
+            # documents have an error and deleted ones a null doc.
+            docs = []
+            for row in result._rows:
+                if row.get('doc'):
+                    docs.append(Document(self, row['doc']))
+                else:
+                    docs.append(None)
+            callback(TrombiResult(docs))
+
+        self.view_many(None, '_all_docs', doc_ids, _really_callback,
+                       chunk_size=chunk_size, concurrency=concurrency,
+                       include_docs=True)
+
+    def update_handler(self, design_doc, handler, callback, doc_id=None,
+                       body=None, query=None):
+        def _really_callback(response):
+            if response.code in (200, 201, 202):
+                content = response.body
+                content_type = response.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    content = response.json()
+                callback(UpdateResult(
+                    content,
+                    response.headers.get('X-Couch-Id'),
+                    response.headers.get('X-Couch-Update-NewRev'),
+                    ))
+            else:
+                callback(_error_response(response))
+
+        url = '_design/%s/_update/%s' % (design_doc, handler)
+        if doc_id is not None:
+            url = '%s/%s' % (url, urlquote(doc_id, safe=''))
+            method = 'PUT'
+        else:
+            method = 'POST'
+        if query:
+            url = '%s?%s' % (url, urlencode(query))
+
+        if body is None:
+            body = ''
+        elif not isinstance(body, _string_types):
+            body = json.dumps(body, cls=self._json_encoder)
+
+        self._fetch(url, _really_callback, method=method, body=body)
+
+    def install_update_handlers(self, callback, design_doc='trombi'):
+        def _got_design_doc(doc):
+            if doc is not None and doc.error:
+                callback(doc)
+                return
+            if doc is None:
+                doc = Document(self, {'language': 'javascript'})
+                doc.id = '_design/%s' % design_doc
+
+            updates = dict(doc.get('updates', {}))
+            updates.update(UPDATE_HANDLERS)
+            doc['updates'] = updates
+            self.set(doc, callback)
+
+        self.get('_design/%s' % design_doc, _got_design_doc)
+
+    def find(self, selector, callback, fields=None, sort=None, limit=None,
+             skip=None, use_index=None, bookmark=None, **kwargs):
+        query = _mango_query(selector, fields, sort, limit, skip,
+                             use_index, bookmark, kwargs)
+        self._find(query, callback)
+
+    def _find(self, query, callback):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(FindResult(response.json(), self, query))
+            else:
+                callback(_error_response(response))
+
+        self._fetch(
+            '_find',
+            _really_callback,
+            method='POST',
+            body=json.dumps(query, cls=self._json_encoder),
+            )
+
+    def find_pages(self, selector, callback, limit=25, **kwargs):
+        def _got_page(result):
+            if result.error:
+                callback(result)
+                return
+            if not result:
+                callback(None)
+                return
+            if callback(result) is False:
+                return
+            if len(result) < limit:
+                callback(None)
+            else:
+                result.next_page(_got_page)
+
+        self.find(selector, _got_page, limit=limit, **kwargs)
+
+    def explain(self, selector, callback, fields=None, sort=None, limit=None,
+                skip=None, use_index=None, bookmark=None, **kwargs):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(TrombiDict(response.json()))
+            else:
+                callback(_error_response(response))
+
+        query = _mango_query(selector, fields, sort, limit, skip,
+                             use_index, bookmark, kwargs)
+        self._fetch(
+            '_explain',
+            _really_callback,
+            method='POST',
+            body=json.dumps(query, cls=self._json_encoder),
+            )
+
+    def create_index(self, fields, callback, ddoc=None, name=None,
+                     index_type='json', partial_filter_selector=None):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(TrombiDict(response.json()))
+            else:
+                callback(_error_response(response))
+
+        index = {'fields': fields}
+        if partial_filter_selector is not None:
+            index['partial_filter_selector'] = partial_filter_selector
+        body = {'index': index, 'type': index_type}
+        if ddoc is not None:
+            body['ddoc'] = ddoc
+        if name is not None:
+            body['name'] = name
+
+        self._fetch(
+            '_index',
+            _really_callback,
+            method='POST',
+            body=json.dumps(body, cls=self._json_encoder),
+            )
+
+    def list_indexes(self, callback):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(TrombiDict(response.json()))
+            else:
+                callback(_error_response(response))
+
+        self._fetch('_index', _really_callback)
+
+    def delete_index(self, ddoc, name, callback, index_type='json'):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(self)
+            else:
+                callback(_error_response(response))
+
+        if ddoc.startswith('_design/'):
+            ddoc = ddoc[len('_design/'):]
+
+        self._fetch(
+            '_index/%s/%s/%s' % (urlquote(ddoc, safe=''), index_type,
+                                 urlquote(name, safe='')),
+            _really_callback,
+            method='DELETE',
+            )
+
     def list(self, design_doc, listname, viewname, callback, **kwargs):
         def _really_callback(response):
             if response.code == 200:
@@ -549,9 +2010,8 @@ class Database(TrombiObject):
                        language='javascript', **kwargs):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
                 callback(
-                    ViewResult(json.loads(body), db=self)
+                    ViewResult(response.json(), db=self)
                     )
             else:
                 callback(_error_response(response))
@@ -571,7 +2031,7 @@ class Database(TrombiObject):
     def delete(self, data, callback):
         def _really_callback(response):
             try:
-                json.loads(response.body.decode('utf-8'))
+                response.json()
             except ValueError:
                 callback(_error_response(response))
                 return
@@ -592,20 +2052,206 @@ class Database(TrombiObject):
             method='DELETE',
             )
 
-    def bulk_docs(self, data, callback, all_or_nothing=False):
+    def revs_diff(self, revs, callback):
+        def _really_callback(response):
+            if response.code == 200:
+                callback(TrombiDict(response.json()))
+            else:
+                callback(_error_response(response))
+
+        self._fetch(
+            '_revs_diff',
+            _really_callback,
+            method='POST',
+            body=json.dumps(revs),
+            )
+
+    def bulk_get(self, docs, callback, revs=False, latest=False,
+                 attachments=False, chunk_size=500, concurrency=4):
+        def _really_callback(results):
+            if isinstance(results, TrombiError):
+                callback(results)
+                return
+            callback(BulkGetResult([
+                x if isinstance(x, BulkError) else Document(self, x)
+                for x in results
+                ]))
+
+        params = {}
+        if revs:
+            params['revs'] = True
+        if latest:
+            params['latest'] = True
+        if attachments:
+            params['attachments'] = True
+
+        self._bulk_get(docs, _really_callback, params,
+                       chunk_size=chunk_size, concurrency=concurrency)
+
+    def _bulk_get(self, docs, callback, params, chunk_size=500,
+                  concurrency=4):
+        # Calls callback with a list of raw documents or BulkErrors in
+        # the order of docs, or with an error
+        items = []
+        for doc in docs:
+            if isinstance(doc, (tuple, list)):
+                items.append(tuple(doc))
+            else:
+                items.append((doc, None))
+
+        def _done(results):
+            merged = []
+            for result in results:
+                if isinstance(result, TrombiError):
+                    callback(result)
+                    return
+                merged.extend(result)
+            callback(merged)
+
+        chunks = [items[i:i + chunk_size]
+                  for i in range(0, len(items), chunk_size)]
+        tasks = [functools.partial(self._bulk_get_chunk, chunk, params)
+                 for chunk in chunks]
+        _parallel(tasks, concurrency, _done)
+
+    def _bulk_get_chunk(self, items, params, callback):
+        if not self.server._bulk_get_supported:
+            self._bulk_get_fallback(items, params, callback)
+            return
+
+        def _really_callback(response):
+            if response.code == 200:
+                body = response.json()
+                callback([_bulk_get_item(x) for x in body['results']])
+            elif _endpoint_missing(response):
+                # Older CouchDB, fetch the documents one by one
+                self.server._bulk_get_supported = False
+                self._bulk_get_fallback(items, params, callback)
+            else:
+                callback(_error_response(response))
+
+        url = '_bulk_get'
+        if params:
+            url = '%s?%s' % (url, _jsonize_params(params))
+
+        body = {'docs': []}
+        for doc_id, rev in items:
+            if rev is None:
+                body['docs'].append({'id': doc_id})
+            else:
+                body['docs'].append({'id': doc_id, 'rev': rev})
+
+        self._fetch(
+            url,
+            _really_callback,
+            method='POST',
+            body=json.dumps(body),
+            headers=HTTPHeaders({'Content-Type': 'application/json',
+                                 'Accept': 'application/json'}),
+            )
+
+    def _bulk_get_fallback(self, items, params, callback):
+        def _task(doc_id, rev):
+            def _run(done):
+                def _really_callback(response):
+                    if response.code == 200:
+                        body = response.json()
+                        if rev is None:
+                            done(body)
+                            return
+                        # open_revs responds with a list
+                        docs = [x['ok'] for x in body if 'ok' in x]
+                        if docs:
+                            done(docs[0])
+                            return
+                    elif response.code != 404:
+                        done(_error_response(response))
+                        return
+                    done(BulkError({
+                        'id': doc_id,
+                        'rev': rev,
+                        'error': 'not_found',
+                        'reason': 'missing',
+                        }))
+
+                query = dict(params)
+                if rev is not None:
+                    query['open_revs'] = [rev]
+
+                url = urlquote(doc_id, safe='')
+                if query:
+                    url = '%s?%s' % (url, _jsonize_params(query))
+
+                self._fetch(
+                    url,
+                    _really_callback,
+                    headers=HTTPHeaders({'Content-Type': 'application/json',
+                                         'Accept': 'application/json'}),
+                    )
+            return _run
+
+        def _done(results):
+            for result in results:
+                if isinstance(result, TrombiErrorResponse):
+                    callback(result)
+                    return
+            callback(results)
+
+        tasks = [_task(doc_id, rev) for doc_id, rev in items]
+        _parallel(tasks, self.server.bulk_get_fallback_concurrency, _done)
+
+    def bulk_docs(self, data, callback, all_or_nothing=False,
+                  new_edits=True, skip_clean=False):
+        data = list(data)
+        written = []
+        skipped = {}
+        for index, element in enumerate(data):
+            if (skip_clean and isinstance(element, Document) and
+                not element.dirty):
+                skipped[index] = {
+                    'id': element.id,
+                    'rev': element.rev,
+                    'ok': True,
+                    'skipped': True,
+                    }
+            else:
+                written.append(element)
+
+        def _merge(content):
+            # Put the results of skipped documents in their places
+            content = iter(content)
+            return BulkResult([
+                skipped[i] if i in skipped else next(content)
+                for i in range(len(data))
+                ])
+
         def _really_callback(response):
             if response.code == 200 or response.code == 201:
                 try:
-                    content = json.loads(response.body.decode('utf-8'))
+                    content = response.json()
                 except ValueError:
                     callback(TrombiErrorResponse(response.code, response.body))
-                else:
+                    return
+                if new_edits is False:
+                    # Only the failures are reported
                     callback(BulkResult(content))
+                    return
+                for element, line in zip(written, content):
+                    if isinstance(element, Document) and 'error' not in line:
+                        element.id = line['id']
+                        element.rev = line['rev']
+                        element.mark_clean()
+                callback(_merge(content))
             else:
                 callback(_error_response(response))
 
+        if not written:
+            self.server.io_loop.add_callback(trombi.tracing.wrap(
+                functools.partial(callback, _merge([]))))
+            return
+
         docs = []
-        for element in data:
+        for element in written:
             if isinstance(element, Document):
                 docs.append(element.raw())
             else:
@@ -614,76 +2260,751 @@ class Database(TrombiObject):
         payload = {'docs': docs}
         if all_or_nothing is True:
             payload['all_or_nothing'] = True
+        if new_edits is False:
+            payload['new_edits'] = False
 
         self._fetch(
             '_bulk_docs',
             _really_callback,
             method='POST',
-            body=json.dumps(payload),
+            encode=lambda: json.dumps(payload, cls=self._json_encoder),
+            offload=len(docs) >= self.server.encode_batch_threshold,
+            compress=True,
             )
 
-    def changes(self, callback, timeout=None, feed='normal', **kw):
-        def _really_callback(response):
-            log.debug('Changes feed response: %s', response)
-            if response.code != 200:
-                callback(_error_response(response))
+    def changes(self, callback, timeout=None, feed='normal',
+                max_pending=None, manual_ack=False, **kw):
+        if max_pending is not None:
+            if feed != 'continuous':
+                raise ValueError('max_pending needs a continuous feed')
+            if max_pending < 1:
+                raise ValueError('max_pending must be at least 1')
+
+        handle = ChangesFeed(max_pending, manual_ack)
+        # The changes are passed on with the span active now
+        span = trombi.tracing.active_span()
+
+        def _deliver(change):
+            if handle.stopped:
                 return
+            if not manual_ack:
+                handle.ack()
+            callback(change)
+
+        def _open(since=None):
+            # Responses of the connections closed because of a full
+            # window are ignored
+            handle._requests += 1
+            request = handle._requests
+            stream_buffer = []
+
+            def _really_callback(response):
+                log.debug('Changes feed response: %s', response)
+                if handle.stopped or request != handle._requests:
+                    # The feed was closed on purpose
+                    return
+                if response.code != 200:
+                    callback(_error_response(response))
+                    return
+                if feed == 'continuous':
+                    # Feed terminated, call callback with None to
+                    # indicate this, if the mode is continous
+                    callback(None)
+                else:
+                    callback(TrombiResult(response.json()))
+
+            def _stream(text):
+                if handle.stopped or request != handle._requests:
+                    # Raising in the streaming callback makes the HTTP
+                    # client close the connection
+                    raise _FeedStopped()
+
+                stream_buffer.append(text.decode('utf-8'))
+                chunks = ''.join(stream_buffer).split('\n')
+
+                # The last chunk is either an empty string or an
+                # incomplete line. Save it for the next round. The [:]
+                # syntax is used because of variable scoping.
+                stream_buffer[:] = [chunks.pop()]
+
+                for chunk in chunks:
+                    if not chunk.strip():
+                        continue
+
+                    try:
+                        obj = json.loads(chunk)
+                    except ValueError:
+                        # JSON parsing failed. Apparently we have some
+                        # gibberish on our hands, just discard it.
+                        log.warning('Invalid changes feed line: %s' % chunk)
+                        continue
+
+                    if 'seq' in obj:
+                        handle.last_seq = obj['seq']
+                    elif 'last_seq' in obj:
+                        handle.last_seq = obj['last_seq']
+
+                    # "Escape" the streaming_callback context by
+                    # invoking the handler as an ioloop callback. This
+                    # makes it possible to start new HTTP requests in
+                    # the handler (it is impossible in the
+                    # streaming_callback context). Tornado runs these
+                    # callbacks in the order they were added, so this
+                    # works correctly.
+                    #
+                    # This also relieves us from handling exceptions in
+                    # the handler.
+                    handle.pending += 1
+                    cb = functools.partial(_deliver, TrombiDict(obj))
+                    self.server.io_loop.add_callback(
+                        trombi.tracing.wrap(cb, span))
+
+                if handle.max_pending is not None and \
+                        handle.pending >= handle.max_pending:
+                    # The consumer is falling behind. Disconnect and
+                    # continue from the last queued change once the
+                    # window has drained. The incomplete line in the
+                    # buffer is read again then.
+                    handle._pause()
+                    raise _FeedStopped()
+
+            couchdb_params = dict(kw)
+            couchdb_params['feed'] = feed
+            if since is not None:
+                couchdb_params['since'] = since
+            params = dict()
+            if couchdb_params.get('heartbeat') and feed != 'normal':
+                # CouchDB keeps the feed open as long as it sends the
+                # heartbeat and ignores the timeout. Turn off the
+                # timeout of the HTTP client (0 in Tornado).
+                params['request_timeout'] = 0
+            elif timeout is not None:
+                # CouchDB takes timeouts in milliseconds
+                couchdb_params['timeout'] = timeout * 1000
+                params['request_timeout'] = timeout + 1
+            url = '_changes?%s' % urlencode(couchdb_params)
             if feed == 'continuous':
-                # Feed terminated, call callback with None to indicate
-                # this, if the mode is continous
-                callback(None)
+                params['streaming_callback'] = _stream
+
+            log.debug('Fetching changes from %s with params %s', url, params)
+            self._fetch(url, _really_callback, **params)
+
+        handle._resume = lambda: _open(handle.last_seq)
+        _open()
+        return handle
+
+    def follow(self, callback, since=0, **kw):
+        follower = ChangesFollower(self, callback, since=since, **kw)
+        follower.start()
+        return follower
+
+    def fragmentation(self, callback):
+        def _really_callback(info):
+            if info.error:
+                callback(info)
+                return
+            disk_size, data_size = _database_sizes(info)
+            if not data_size:
+                callback(TrombiResult(None))
             else:
-                body = response.body.decode('utf-8')
-                callback(TrombiResult(json.loads(body)))
+                callback(TrombiResult(disk_size / float(data_size)))
 
-        stream_buffer = []
+        self.info(_really_callback)
 
-        def _stream(text):
-            stream_buffer.append(text.decode('utf-8'))
-            chunks = ''.join(stream_buffer).split('\n')
+    def watch_seq(self, callback):
+        watchers = self.server._seq_watchers
+        if self.name not in watchers:
+            watchers[self.name] = SeqWatcher(self)
+        return watchers[self.name].subscribe(callback)
 
-            # The last chunk is either an empty string or an
-            # incomplete line. Save it for the next round. The [:]
-            # syntax is used because of variable scoping.
-            stream_buffer[:] = [chunks.pop()]
+    def changes_hub(self, **kw):
+        key = (self.name, repr(sorted(kw.items())))
+        hubs = self.server._changes_hubs
+        if key not in hubs:
+            hubs[key] = ChangesHub(self, **kw)
+        return hubs[key]
 
-            for chunk in chunks:
-                if not chunk.strip():
-                    continue
 
-                try:
-                    obj = json.loads(chunk)
-                except ValueError:
-                    # JSON parsing failed. Apparently we have some
-                    # gibberish on our hands, just discard it.
-                    log.warning('Invalid changes feed line: %s' % chunk)
-                    continue
-
-                # "Escape" the streaming_callback context by invoking
-                # the handler as an ioloop callback. This makes it
-                # possible to start new HTTP requests in the handler
-                # (it is impossible in the streaming_callback
-                # context). Tornado runs these callbacks in the order
-                # they were added, so this works correctly.
-                #
-                # This also relieves us from handling exceptions in
-                # the handler.
-                cb = functools.partial(callback, TrombiDict(obj))
-                self.server.io_loop.add_callback(cb)
-
-        couchdb_params = kw
-        couchdb_params['feed'] = feed
-        params = dict()
-        if timeout is not None:
-            # CouchDB takes timeouts in milliseconds
-            couchdb_params['timeout'] = timeout * 1000
-            params['request_timeout'] = timeout + 1
-        url = '_changes?%s' % urlencode(couchdb_params)
-        if feed == 'continuous':
-            params['streaming_callback'] = _stream
-
-        log.debug('Fetching changes from %s with params %s', url, params)
-        self._fetch(url, _really_callback, **params)
+class _FeedStopped(Exception):
+    pass
+
+
+class ChangesFeed(TrombiObject):
+    """
+    A handle to a changes feed, returned by Database.changes.
+    """
+    def __init__(self, max_pending=None, manual_ack=False):
+        self.stopped = False
+        self.last_seq = None
+        self.max_pending = max_pending
+        self.manual_ack = manual_ack
+        self.pending = 0
+        self.paused = False
+        self.pauses = 0
+        self._requests = 0
+        self._resume = None
+
+    def stop(self):
+        self.stopped = True
+
+    def ack(self):
+        self.pending -= 1
+        if self.paused and not self.stopped and \
+                self.pending <= self.max_pending // 2:
+            # Enough room in the window again
+            self.paused = False
+            self._resume()
+
+    def stats(self):
+        return TrombiDict(
+            pending=self.pending,
+            max_pending=self.max_pending,
+            paused=self.paused,
+            pauses=self.pauses,
+            )
+
+    def _pause(self):
+        self.paused = True
+        self.pauses += 1
+        # Invalidate the current connection
+        self._requests += 1
+
+
+class ChangesSubscription(TrombiObject):
+    def __init__(self, hub, callback, predicate=None, doc_ids=None):
+        self.hub = hub
+        self.callback = callback
+        self.predicate = predicate
+        self.active = True
+        # The changes are passed on with the span active when
+        # subscribing, as the feed is shared
+        self._span = trombi.tracing.active_span()
+        if doc_ids is None:
+            self.doc_ids = None
+        else:
+            self.doc_ids = frozenset(doc_ids)
+
+    def matches(self, change):
+        if self.doc_ids is not None and change.get('id') not in self.doc_ids:
+            return False
+        if self.predicate is not None and not self.predicate(change):
+            return False
+        return True
+
+    def cancel(self):
+        self.hub.unsubscribe(self)
+
+    def _deliver(self, change):
+        if self.active:
+            trombi.tracing.wrap(self.callback, self._span)(change)
+
+
+class ChangesHub(TrombiObject):
+    """
+    Shares one continuous changes feed of a database between many
+    subscribers. The feed is opened when the first subscriber arrives
+    and stopped when the last one leaves. Every change is parsed only
+    once and the same object is passed to all the subscribers.
+    """
+    def __init__(self, db, since=None, timeout=60, heartbeat=5,
+                 retry_delay=1, **kw):
+        self.db = db
+        self.since = since
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self._kw = kw
+        self._subscribers = []
+        self._feed = None
+        self._starting = False
+
+    @property
+    def running(self):
+        return self._feed is not None or self._starting
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def subscribe(self, callback, predicate=None, doc_ids=None):
+        subscription = ChangesSubscription(
+            self, callback, predicate=predicate, doc_ids=doc_ids)
+        self._subscribers.append(subscription)
+        if not self.running:
+            self._start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        try:
+            self._subscribers.remove(subscription)
+        except ValueError:
+            # Already unsubscribed
+            return
+        subscription.active = False
+        if not self._subscribers and self._feed is not None:
+            self._feed.stop()
+            self._feed = None
+
+    def _start(self):
+        if self.since is None:
+            # Start from the current state of the database
+            self._starting = True
+            self.db.info(self._got_info, max_age=0)
+        else:
+            self._open_feed()
+
+    def _got_info(self, info):
+        self._starting = False
+        if not self._subscribers:
+            return
+        if info.error:
+            log.warning('Unable to start changes hub for %s: %s',
+                        self.db.name, info.msg)
+            self._retry()
+            return
+        self.since = info['update_seq']
+        self._open_feed()
+
+    def _open_feed(self):
+        kw = dict(self._kw)
+        kw['since'] = self.since
+        if self.heartbeat is not None:
+            # A stopped feed is only disconnected when something
+            # arrives, so keep the heartbeat going. CouchDB takes it in
+            # milliseconds. The feed then stays open without a timeout.
+            kw['heartbeat'] = self.heartbeat * 1000
+        else:
+            kw['timeout'] = self.timeout
+        self._feed = self.db.changes(
+            self._got_change, feed='continuous', **kw)
+
+    def _retry(self):
+        self._starting = True
+
+        def _restart():
+            self._starting = False
+            if self._subscribers and self._feed is None:
+                self._start()
+
+        self.db.server.io_loop.add_timeout(
+            time.time() + self.retry_delay, _restart)
+
+    def _got_change(self, change):
+        if change is None or change.error:
+            # The feed ended, either by a timeout or an error. Reopen
+            # it from where we left, if anyone is still listening.
+            if change is not None:
+                log.warning('Changes hub feed for %s failed: %s',
+                            self.db.name, change.msg)
+            self._feed = None
+            if self._subscribers:
+                if change is None:
+                    self._start()
+                else:
+                    self._retry()
+            return
+
+        if 'last_seq' in change:
+            self.since = change['last_seq']
+            return
+
+        self.since = change['seq']
+        for subscription in self._subscribers:
+            if subscription.matches(change):
+                # Like Database.changes, keep the subscribers from
+                # affecting each other by running them as separate
+                # ioloop callbacks
+                self.db.server.io_loop.add_callback(
+                    functools.partial(subscription._deliver, change))
+
+
+class SeqWatcher(TrombiObject):
+    """
+    Polls the info of a database for its subscribers, and tells them
+    when the update_seq has moved. One watcher per database is shared
+    by all the subscribers of a server.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.update_seq = None
+        self._subscribers = []
+        self._polling = False
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def subscribe(self, callback):
+        subscription = ChangesSubscription(self, callback)
+        self._subscribers.append(subscription)
+        if not self._polling:
+            self._polling = True
+            self._poll()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        try:
+            self._subscribers.remove(subscription)
+        except ValueError:
+            # Already unsubscribed
+            return
+        subscription.active = False
+
+    def _poll(self):
+        if not self._subscribers:
+            self._polling = False
+            # Start from the state of the database the next time
+            self.update_seq = None
+            return
+        # A cached info that is fresh enough for the interval is as
+        # good as a new one
+        self.db.info(self._got_info,
+                     max_age=self.db.server.seq_poll_interval)
+
+    def _got_info(self, info):
+        if info.error:
+            log.warning('Unable to poll the info of %s: %s',
+                        self.db.name, info.msg)
+        elif self.update_seq is None:
+            self.update_seq = info['update_seq']
+        elif info['update_seq'] != self.update_seq:
+            self.update_seq = info['update_seq']
+            for subscription in list(self._subscribers):
+                subscription._deliver(copy.deepcopy(info))
+        self.db.server.io_loop.add_timeout(
+            time.time() + self.db.server.seq_poll_interval, self._poll)
+
+
+class CompactionScheduler(TrombiObject):
+    """
+    Compacts databases of a server and their views, running at most
+    max_concurrent compactions at a time. Databases are only compacted
+    if their files are at least threshold times larger than their
+    data.
+    """
+    def __init__(self, server, threshold=2.0, max_concurrent=1,
+                 poll_interval=5, views=True):
+        self.server = server
+        self.threshold = threshold
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.views = views
+        self.progress = TrombiDict()
+        self._queue = collections.deque()
+        self._running = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def check(self, databases, callback):
+        # Compacts the fragmented ones of the databases
+        databases = [
+            Database(self.server, db) if isinstance(db, _string_types) else db
+            for db in databases]
+        # The same database may be given twice, keep the results in
+        # the order of the databases
+        results = [None] * len(databases)
+        state = {'finished': 0}
+
+        def _finished(index, result):
+            results[index] = result
+            state['finished'] += 1
+            if state['finished'] == len(databases):
+                callback(TrombiResult(results))
+
+        def _checked(index, db, ratio):
+            if ratio.error:
+                _finished(index, ratio)
+            elif ratio.content is not None and \
+                    ratio.content >= self.threshold:
+                self.compact(
+                    db, functools.partial(_finished, index))
+            else:
+                _finished(index, TrombiResult('skipped'))
+
+        if not databases:
+            callback(TrombiResult(results))
+        for index, db in enumerate(databases):
+            db.fragmentation(functools.partial(_checked, index, db))
+
+    def compact(self, db, callback):
+        # Compacts the database regardless of the fragmentation, once
+        # there is room for it
+        self.progress[db.name] = 0
+        self._queue.append((db, callback))
+        self._start_next()
+
+    def _start_next(self):
+        while self._queue and self._running < self.max_concurrent:
+            self._running += 1
+            db, callback = self._queue.popleft()
+            self._compact(db, callback)
+
+    def _compact(self, db, callback):
+        def _done(result):
+            self._running -= 1
+            if not result.error:
+                self.progress[db.name] = 100
+            else:
+                self.progress.pop(db.name, None)
+            self._start_next()
+            callback(result)
+
+        def _compacted(result):
+            if result.error:
+                _done(result)
+            else:
+                self._wait(db, 'database_compaction', None,
+                           lambda cb: db.info(cb, max_age=0), _compact_views)
+
+        def _compact_views(result):
+            if result.error:
+                _done(result)
+            elif self.views:
+                db.design_docs(_got_design_docs)
+            else:
+                _done(TrombiResult('compacted'))
+
+        def _got_design_docs(design_docs):
+            if design_docs.error:
+                _done(design_docs)
+                return
+            remaining = list(design_docs.content)
+
+            def _next(result=None):
+                if result is not None and result.error:
+                    _done(result)
+                elif remaining:
+                    name = remaining.pop(0)
+                    db.compact_views(name, functools.partial(
+                        _views_started, name, _next))
+                else:
+                    db.view_cleanup(_cleaned)
+
+            _next()
+
+        def _views_started(name, next, result):
+            if result.error:
+                next(result)
+            else:
+                self._wait(
+                    db, 'view_compaction', '_design/%s' % name,
+                    lambda cb: db.view_info(
+                        name, lambda info: cb(
+                            info if info.error else
+                            TrombiDict(info['view_index']))),
+                    next)
+
+        def _cleaned(result):
+            if result.error:
+                _done(result)
+            else:
+                _done(TrombiResult('compacted'))
+
+        db.compact(_compacted)
+
+    def _wait(self, db, task_type, design_doc, get_info, callback):
+        # Polls the compaction until it is no longer running, keeping
+        # track of its progress
+        def _poll():
+            get_info(_got_info)
+
+        def _got_info(info):
+            if info.error:
+                callback(info)
+            elif not info.get('compact_running'):
+                callback(TrombiObject())
+            else:
+                self.server.active_tasks(_got_tasks)
+
+        def _got_tasks(tasks):
+            if not tasks.error:
+                tasks = [
+                    task for task in tasks.content
+                    if task.get('type') == task_type and
+                    _task_database(task) == db.name and
+                    task.get('design_document') == design_doc]
+                if tasks and design_doc is None:
+                    self.progress[db.name] = _task_progress(tasks)
+            self.server.io_loop.add_timeout(
+                time.time() + self.poll_interval, _poll)
+
+        _poll()
+
+
+class ChangesFollower(TrombiObject):
+    """
+    Follows the changes of a database. A consumer far behind first
+    catches up with batches of the normal feed, always asking for the
+    next batch before handing out the previous one, and switches to
+    the continuous feed once it is close enough.
+    """
+    def __init__(self, db, callback, since=0, batch_size=1000,
+                 threshold=None, heartbeat=30, retry_delay=1,
+                 caught_up_callback=None, max_pending=None, **kw):
+        if threshold is None:
+            threshold = batch_size
+        self.db = db
+        self.callback = callback
+        self.since = since
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self.caught_up_callback = caught_up_callback
+        self.max_pending = max_pending
+        self._kw = kw
+        self.mode = None
+        self.stopped = False
+        self._feed = None
+        self._changes = 0
+        self._batches = 0
+        self._catchup_changes = 0
+        self._catchup_started = None
+        self._catchup_time = 0.0
+        self._lag = None
+        self._queued = 0
+        self._span = trombi.tracing.active_span()
+
+    def start(self):
+        self.mode = 'catchup'
+        self._catchup_started = time.time()
+        self._fetch_batch(self.since)
+
+    def stop(self):
+        self.stopped = True
+        if self._feed is not None:
+            self._feed.stop()
+            self._feed = None
+
+    def stats(self):
+        catchup_time = self._catchup_time
+        if self.mode == 'catchup':
+            catchup_time += time.time() - self._catchup_started
+        if catchup_time > 0:
+            rate = self._catchup_changes / catchup_time
+        else:
+            rate = 0.0
+        pending = self._queued
+        if self._feed is not None:
+            pending += self._feed.pending
+        if self.mode == 'catchup':
+            lag = self._lag
+        else:
+            lag = None
+        return TrombiDict(
+            mode=self.mode,
+            changes=self._changes,
+            batches=self._batches,
+            catchup_changes=self._catchup_changes,
+            catchup_time=catchup_time,
+            catchup_changes_per_second=rate,
+            lag=lag,
+            pending=pending,
+            last_seq=self.since,
+            )
+
+    def _fetch_batch(self, since):
+        self.db.changes(
+            self._got_batch, since=since, limit=self.batch_size, **self._kw)
+
+    def _got_batch(self, result):
+        if self.stopped:
+            return
+        if result.error:
+            log.warning('Catching up changes of %s failed: %s',
+                        self.db.name, result.msg)
+            self._retry(self._fetch_batch, self.since)
+            return
+
+        changes = result.content['results']
+        last_seq = result.content['last_seq']
+        # Only CouchDB 2 and newer tell the number of changes left
+        pending = result.content.get('pending')
+        if pending is not None:
+            caught_up = pending <= self.threshold
+        else:
+            caught_up = len(changes) < self.batch_size
+        self._lag = pending
+        self._batches += 1
+
+        if not caught_up:
+            # Let CouchDB work on the next batch while this one is
+            # handled
+            self._fetch_batch(last_seq)
+
+        # Hand out the changes as IOLoop callbacks like
+        # Database.changes does, so that an exception in the consumer
+        # doesn't stop the rest of the batch or the following
+        for change in changes:
+            self._queued += 1
+            self.db.server.io_loop.add_callback(
+                functools.partial(self._deliver_queued, TrombiDict(change)))
+        self._catchup_changes += len(changes)
+        self.since = last_seq
+
+        if caught_up and not self.stopped:
+            self._catchup_time += time.time() - self._catchup_started
+            self.mode = 'continuous'
+            self._open_feed()
+            if self.caught_up_callback is not None:
+                # After the changes of the last batch
+                self.db.server.io_loop.add_callback(trombi.tracing.wrap(
+                    functools.partial(self.caught_up_callback, self),
+                    self._span))
+
+    def _open_feed(self):
+        kw = dict(self._kw)
+        if self.max_pending is not None:
+            kw['max_pending'] = self.max_pending
+        # CouchDB takes the heartbeat in milliseconds
+        self._feed = self.db.changes(
+            self._got_change, feed='continuous', since=self.since,
+            heartbeat=self.heartbeat * 1000, **kw)
+
+    def _got_change(self, change):
+        if change is None or change.error:
+            # The feed ended. Open it again from where we left.
+            if change is not None:
+                log.warning('Changes feed of %s failed: %s',
+                            self.db.name, change.msg)
+            self._feed = None
+            if self.stopped:
+                return
+            if change is None:
+                self._open_feed()
+            else:
+                self._retry(self._open_feed)
+            return
+
+        if 'last_seq' in change:
+            self.since = change['last_seq']
+            return
+
+        self.since = change['seq']
+        self._deliver(change)
+
+    def _deliver_queued(self, change):
+        self._queued -= 1
+        if not self.stopped:
+            self._deliver(change)
+
+    def _deliver(self, change):
+        self._changes += 1
+        trombi.tracing.wrap(self.callback, self._span)(change)
+
+    def _retry(self, func, *args):
+        def _again():
+            if not self.stopped:
+                func(*args)
+
+        self.db.server.io_loop.add_timeout(
+            time.time() + self.retry_delay, _again)
 
 
 class Document(collections.MutableMapping, TrombiObject):
@@ -694,6 +3015,12 @@ class Document(collections.MutableMapping, TrombiObject):
         self.rev = None
         self._postponed_attachments = False
         self.attachments = {}
+        self._decoded_attachments = {}
+
+        # Tracking changes made inside the values is opt-in, as it
+        # needs a fingerprint of the whole document
+        server = getattr(db, 'server', None)
+        self.track_nested = getattr(server, 'track_nested_changes', False)
 
         for key, value in data.items():
             if key.startswith('_'):
@@ -701,6 +3028,41 @@ class Document(collections.MutableMapping, TrombiObject):
             else:
                 self[key] = value
 
+        self.mark_clean()
+
+    def _fingerprint(self):
+        encoder = getattr(self.db, '_json_encoder', None)
+        data = json.dumps(self.data, sort_keys=True, cls=encoder)
+        return sha1(data.encode('utf-8')).digest()
+
+    def _attachments_state(self):
+        # References to the attachment fields, so that comparing the
+        # states is cheap when nothing has changed
+        return sorted(
+            (name, attachment.get('content_type'), attachment.get('digest'),
+             attachment.get('revpos'), attachment.get('stub'),
+             attachment.get('data'))
+            for name, attachment in self.attachments.items())
+
+    def mark_clean(self):
+        self._dirty = False
+        self._clean_attachments = self._attachments_state()
+        if self.track_nested:
+            self._clean_fingerprint = self._fingerprint()
+
+    @property
+    def dirty(self):
+        if self.rev is None:
+            # Never saved
+            return True
+        if self._dirty:
+            return True
+        if self._attachments_state() != self._clean_attachments:
+            return True
+        if self.track_nested:
+            return self._fingerprint() != self._clean_fingerprint
+        return False
+
     def __len__(self):
         return len(self.data)
 
@@ -716,10 +3078,16 @@ class Document(collections.MutableMapping, TrombiObject):
     def __setitem__(self, key, value):
         if key.startswith('_'):
             raise KeyError("Keys starting with '_' are reserved for CouchDB")
+        # Setting an equal value is not a change, but setting the same
+        # object again is taken as a sign of modifying it in place
+        if not (key in self.data and self.data[key] is not value and
+                self.data[key] == value):
+            self._dirty = True
         self.data[key] = value
 
     def __delitem__(self, key):
         del self.data[key]
+        self._dirty = True
 
     def raw(self):
         result = {}
@@ -741,7 +3109,7 @@ class Document(collections.MutableMapping, TrombiObject):
                 callback(_error_response(response))
                 return
 
-            content = json.loads(response.body.decode('utf-8'))
+            content = response.json()
             doc = Document(self.db, self.data)
             doc.attachments = self.attachments.copy()
             doc.id = content['id']
@@ -761,7 +3129,7 @@ class Document(collections.MutableMapping, TrombiObject):
             if  response.code != 201:
                 callback(_error_response(response))
                 return
-            data = json.loads(response.body.decode('utf-8'))
+            data = response.json()
             assert data['id'] == self.id
             self.rev = data['rev']
             self.attachments[name] = {
@@ -769,6 +3137,9 @@ class Document(collections.MutableMapping, TrombiObject):
                 'length': len(data),
                 'stub': True,
             }
+            # The attachment is saved already
+            self._clean_attachments = self._attachments_state()
+            self._prune_decoded_attachments()
             callback(self)
 
         headers = {'Content-Type': type, 'Expect': ''}
@@ -784,6 +3155,14 @@ class Document(collections.MutableMapping, TrombiObject):
             headers=headers,
             )
 
+    def _prune_decoded_attachments(self):
+        # Drops the decoded data of the attachments that have been
+        # replaced or deleted since
+        for name, (attachment, data) in list(
+                self._decoded_attachments.items()):
+            if attachment is not self.attachments.get(name):
+                del self._decoded_attachments[name]
+
     def load_attachment(self, name, callback):
         def _really_callback(response):
             if response.code == 200:
@@ -791,11 +3170,27 @@ class Document(collections.MutableMapping, TrombiObject):
             else:
                 callback(_error_response(response))
 
-        if (hasattr(self, 'attachments') and
+        # The decoded data is valid as long as the attachment has not
+        # been replaced
+        self._prune_decoded_attachments()
+        attachment, data = self._decoded_attachments.get(name, (None, None))
+        if attachment is not None:
+            callback(data)
+        elif (hasattr(self, 'attachments') and
             name in self.attachments and
             not self.attachments[name].get('stub', False)):
-            data = self.attachments[name]['data'].encode('utf-8')
-            callback(b64decode(data))
+            attachment = self.attachments[name]
+            data = b64decode(attachment['data'].encode('utf-8'))
+            self._decoded_attachments[name] = (attachment, data)
+            if getattr(self.db.server, 'drop_attachment_data', False):
+                # Keep only the decoded copy. The attachment is saved
+                # as a stub, which keeps the one in the database.
+                clean = self._attachments_state() == self._clean_attachments
+                del attachment['data']
+                attachment['stub'] = True
+                if clean:
+                    self._clean_attachments = self._attachments_state()
+            callback(data)
         else:
             self.db._fetch(
                 '%s/%s' % (
@@ -810,6 +3205,11 @@ class Document(collections.MutableMapping, TrombiObject):
             if response.code != 200:
                 callback(_error_response(response))
                 return
+            content = response.json()
+            self.rev = content['rev']
+            self.attachments.pop(name, None)
+            self._clean_attachments = self._attachments_state()
+            self._prune_decoded_attachments()
             callback(self)
 
         self.db._fetch(
@@ -819,6 +3219,61 @@ class Document(collections.MutableMapping, TrombiObject):
             )
 
 
+class UpdateResult(TrombiResult):
+    """
+    The result of an update handler. The content is the response body
+    of the handler, JSON decoded if it was JSON.
+    """
+    def __init__(self, content, id, rev):
+        super(UpdateResult, self).__init__(content)
+        self.id = id
+        self.rev = rev
+
+
+# Update handlers installed by Database.install_update_handlers. They
+# all take a JSON object with the field to modify as the request body
+# and respond with the new value of the field.
+UPDATE_HANDLERS = {
+    'increment': """(
+function (doc, req) {
+    if (!doc) {
+        return [null, {code: 404, json: {error: 'not_found',
+                                         reason: 'missing'}}];
+    }
+    var body = JSON.parse(req.body);
+    var by = body.by === undefined ? 1 : body.by;
+    doc[body.field] = (doc[body.field] || 0) + by;
+    return [doc, {json: {ok: true, value: doc[body.field]}}];
+}
+)""",
+    'set_field': """(
+function (doc, req) {
+    if (!doc) {
+        return [null, {code: 404, json: {error: 'not_found',
+                                         reason: 'missing'}}];
+    }
+    var body = JSON.parse(req.body);
+    doc[body.field] = body.value;
+    return [doc, {json: {ok: true, value: doc[body.field]}}];
+}
+)""",
+    'append': """(
+function (doc, req) {
+    if (!doc) {
+        return [null, {code: 404, json: {error: 'not_found',
+                                         reason: 'missing'}}];
+    }
+    var body = JSON.parse(req.body);
+    if (!doc[body.field]) {
+        doc[body.field] = [];
+    }
+    doc[body.field].push(body.value);
+    return [doc, {json: {ok: true, value: doc[body.field]}}];
+}
+)""",
+    }
+
+
 class BulkError(TrombiError):
     def __init__(self, data):
         self.error_type = data['error']
@@ -826,6 +3281,17 @@ class BulkError(TrombiError):
         self.raw = data
 
 
+def _bulk_get_item(result):
+    # Picks the document, or the error, of a single _bulk_get result
+    for entry in result['docs']:
+        if 'ok' in entry:
+            return entry['ok']
+    if result['docs']:
+        return BulkError(result['docs'][0]['error'])
+    return BulkError({'id': result.get('id'), 'error': 'not_found',
+                      'reason': 'missing'})
+
+
 class BulkObject(TrombiObject, collections.Mapping):
     def __init__(self, data):
         self._data = data
@@ -862,16 +3328,29 @@ class BulkResult(TrombiResult, collections.Sequence):
         return self.content[key]
 
 
+class BulkGetResult(BulkResult):
+    def __init__(self, content):
+        self.content = content
+
+
 class ViewResult(TrombiObject, collections.Sequence):
     def __init__(self, result, db=None):
         self.db = db
         self.total_rows = result.get('total_rows', len(result['rows']))
         self._rows = result['rows']
         self.offset = result.get('offset', 0)
+        # The same document can be included on many rows, e.g. when
+        # emitting {_id: ...} for linked documents. Share one Document
+        # per id and revision between the rows.
+        self._docs = {}
 
     def _format_row(self, row):
-        if 'doc' in row and row['doc']:
-            row['doc'] = Document(self.db, row['doc'])
+        doc = row.get('doc')
+        if doc and not isinstance(doc, Document):
+            key = (doc.get('_id'), doc.get('_rev'))
+            if key not in self._docs:
+                self._docs[key] = Document(self.db, doc)
+            row['doc'] = self._docs[key]
         return row
 
     def __len__(self):
@@ -884,6 +3363,54 @@ class ViewResult(TrombiObject, collections.Sequence):
         return self._format_row(self._rows[key])
 
 
+def _mango_query(selector, fields, sort, limit, skip, use_index, bookmark,
+                 extra):
+    query = {'selector': selector}
+    if fields is not None:
+        query['fields'] = fields
+    if sort is not None:
+        query['sort'] = sort
+    if limit is not None:
+        query['limit'] = limit
+    if skip is not None:
+        query['skip'] = skip
+    if use_index is not None:
+        query['use_index'] = use_index
+    if bookmark is not None:
+        query['bookmark'] = bookmark
+    query.update(extra)
+    return query
+
+
+class FindResult(TrombiObject, collections.Sequence):
+    """
+    The documents found by a Mango query. Behaves like a sequence of
+    Documents.
+    """
+    def __init__(self, result, db=None, query=None):
+        self.db = db
+        self.query = query
+        self.bookmark = result.get('bookmark')
+        self.warning = result.get('warning')
+        self.execution_stats = result.get('execution_stats')
+        self._docs = [Document(db, x) for x in result['docs']]
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __iter__(self):
+        return iter(self._docs)
+
+    def __getitem__(self, key):
+        return self._docs[key]
+
+    def next_page(self, callback):
+        query = dict(self.query)
+        query['bookmark'] = self.bookmark
+        query.pop('skip', None)
+        self.db._find(query, callback)
+
+
 class Paginator(TrombiObject):
     """
     Provides pseudo pagination of CouchDB documents calculated from
@@ -30,6 +30,8 @@ SERVER_ERROR = 500
 
 # Non-http errors (or overloaded http 500 errors)
 INVALID_DATABASE_NAME = 51
+NO_SESSION_COOKIE = 52
+ENCODING_FAILED = 53
 
 errormap = {
     409: CONFLICT,
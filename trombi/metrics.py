@@ -0,0 +1,192 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Prometheus metrics of CouchDB requests"""
+
+import tornado.web
+
+# Request latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return ('%s' % (value,)).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    return ','.join(
+        '%s="%s"' % (name, _escape(value))
+        for name, value in zip(names, values))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics(object):
+    """
+    Collects the latencies, sizes, errors and number of in-flight
+    requests of the servers it is given to, per operation and
+    database. Renders them in the Prometheus text format.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace='trombi',
+                 per_database=True):
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self.per_database = per_database
+        self._latency = {}
+        self._request_bytes = {}
+        self._response_bytes = {}
+        self._errors = {}
+        self._in_flight = {}
+        self._servers = []
+
+    def _key(self, op, db):
+        if not self.per_database or db is None:
+            db = ''
+        return (op, db)
+
+    def track_server(self, server):
+        # Called by the Server given this instance
+        if server not in self._servers:
+            self._servers.append(server)
+
+    def request_started(self, op, db):
+        key = self._key(op, db)
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def request_finished(self, op, db, code, duration, request_bytes,
+                         response_bytes):
+        key = self._key(op, db)
+        self._in_flight[key] -= 1
+
+        histogram = self._latency.get(key)
+        if histogram is None:
+            histogram = self._latency[key] = _Histogram(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                histogram.counts[i] += 1
+        histogram.sum += duration
+        histogram.count += 1
+
+        self._request_bytes[key] = (
+            self._request_bytes.get(key, 0) + request_bytes)
+        self._response_bytes[key] = (
+            self._response_bytes.get(key, 0) + response_bytes)
+
+        # Code 599 means that no response was received at all
+        if code >= 400:
+            error_key = key + (code,)
+            self._errors[error_key] = self._errors.get(error_key, 0) + 1
+
+    def render(self):
+        lines = []
+
+        def _metric(name, kind, help):
+            name = '%s_%s' % (self.namespace, name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            return name
+
+        def _samples(name, values, label_names=('op', 'db')):
+            for key in sorted(values):
+                lines.append('%s{%s} %s' % (
+                    name, _labels(label_names, key), _number(values[key])))
+
+        name = _metric('request_duration_seconds', 'histogram',
+                       'Latency of CouchDB requests')
+        for key in sorted(self._latency):
+            histogram = self._latency[key]
+            labels = _labels(('op', 'db'), key)
+            for bound, count in zip(self.buckets, histogram.counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    name, labels, _number(float(bound)), count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                name, labels, histogram.count))
+            lines.append('%s_sum{%s} %s' % (
+                name, labels, _number(histogram.sum)))
+            lines.append('%s_count{%s} %d' % (
+                name, labels, histogram.count))
+
+        _samples(_metric('request_bytes_total', 'counter',
+                         'Bytes sent in request bodies'),
+                 self._request_bytes)
+        _samples(_metric('response_bytes_total', 'counter',
+                         'Bytes received in response bodies'),
+                 self._response_bytes)
+        _samples(_metric('request_errors_total', 'counter',
+                         'Failed requests by status code'),
+                 self._errors, ('op', 'db', 'code'))
+        _samples(_metric('requests_in_flight', 'gauge',
+                         'Requests waiting for a response'),
+                 self._in_flight)
+
+        connections = {}
+        compression = {}
+        for server in self._servers:
+            pool = server.pool_stats()
+            for state in ('active', 'idle', 'queued'):
+                connections[(server.baseurl, state)] = pool[state]
+            stats = server.compression_stats()
+            compression[(server.baseurl, 'request')] = (
+                stats['request_bytes'] - stats['request_bytes_compressed'])
+            compression[(server.baseurl, 'response')] = (
+                stats['response_bytes'] - stats['response_bytes_compressed'])
+        if self._servers:
+            _samples(_metric('connections', 'gauge',
+                             'HTTP connections by state'),
+                     connections, ('server', 'state'))
+            _samples(_metric('compression_saved_bytes_total', 'counter',
+                             'Bytes saved by gzip compression'),
+                     compression, ('server', 'direction'))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves the metrics for Prometheus to scrape. Add it to the
+    application with the Metrics instance as an argument::
+
+        (r'/metrics', MetricsHandler, {'metrics': metrics})
+    """
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.metrics.render())
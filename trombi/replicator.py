@@ -0,0 +1,279 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Client-side replication between CouchDB databases"""
+
+from hashlib import sha1
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trombi.client import (TrombiError, TrombiDict, TrombiObject,
+                           _error_response)
+
+log = logging.getLogger('trombi')
+
+
+class _Batch(object):
+    def __init__(self, changes, last_seq):
+        self.changes = changes
+        self.last_seq = last_seq
+        self.done = False
+
+
+class Replicator(TrombiObject):
+    """
+    Replicates the documents of the source database to the target
+    database. The source changes feed is read in batches and only the
+    revisions missing from the target are fetched and written.
+    Reading, fetching and writing of consecutive batches overlap, and
+    the progress is checkpointed in a local document of the target.
+    """
+    def __init__(self, source, target, batch_size=100, concurrency=4,
+                 fetch_concurrency=10, checkpoint=True):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.fetch_concurrency = fetch_concurrency
+        self.checkpoint = checkpoint
+
+        replication = '%s\n%s' % (source.baseurl, target.baseurl)
+        self.replication_id = sha1(replication.encode('utf-8')).hexdigest()
+
+        self.since = 0
+        self.stats = TrombiDict(
+            changes_read=0,
+            missing_checked=0,
+            missing_found=0,
+            docs_read=0,
+            docs_written=0,
+            doc_write_failures=0,
+            last_seq=None,
+            )
+
+        self._callback = None
+        self._batches = []
+        self._reading = False
+        self._finished_reading = False
+        self._done = False
+        self._checkpoint_rev = None
+        self._checkpointing = False
+        self._pending_checkpoint = None
+
+    def start(self, callback, since=None):
+        self._callback = callback
+        if since is not None or not self.checkpoint:
+            if since is not None:
+                self.since = since
+            self.stats['last_seq'] = self.since
+            self._read_next()
+        else:
+            self._load_checkpoint()
+
+    def _checkpoint_url(self):
+        return '_local/%s' % self.replication_id
+
+    def _load_checkpoint(self):
+        def _loaded(response):
+            if response.code == 200:
+                doc = response.json()
+                self._checkpoint_rev = doc['_rev']
+                self.since = doc['source_last_seq']
+            elif response.code != 404:
+                self._fail(_error_response(response))
+                return
+            self.stats['last_seq'] = self.since
+            self._read_next()
+
+        self.target._fetch(self._checkpoint_url(), _loaded)
+
+    def _read_next(self):
+        if self._reading or self._finished_reading or self._done:
+            return
+        if len(self._batches) >= self.concurrency:
+            # Continued when the oldest batch is done
+            return
+
+        self._reading = True
+        self.source.changes(
+            self._got_changes,
+            since=self.since,
+            limit=self.batch_size,
+            style='all_docs',
+            )
+
+    def _got_changes(self, result):
+        self._reading = False
+        if self._done:
+            return
+        if result.error:
+            self._fail(result)
+            return
+
+        changes = result.content['results']
+        if not changes:
+            self._finished_reading = True
+            self._maybe_finish()
+            return
+
+        self.since = result.content['last_seq']
+        if len(changes) < self.batch_size:
+            self._finished_reading = True
+
+        self.stats['changes_read'] += len(changes)
+        batch = _Batch(changes, self.since)
+        self._batches.append(batch)
+
+        # Read the next batch while this one is being processed
+        self._read_next()
+        self._diff(batch)
+
+    def _diff(self, batch):
+        revs = {}
+        for change in batch.changes:
+            revs.setdefault(change['id'], []).extend(
+                x['rev'] for x in change['changes'])
+        self.stats['missing_checked'] += sum(len(x) for x in revs.values())
+
+        def _diffed(result):
+            if self._done:
+                return
+            if result.error:
+                self._fail(result)
+                return
+
+            missing = [(doc_id, diff['missing'])
+                       for doc_id, diff in result.items()]
+            self.stats['missing_found'] += sum(len(x) for _, x in missing)
+            self._fetch_missing(batch, missing)
+
+        self.target.revs_diff(revs, _diffed)
+
+    def _fetch_missing(self, batch, missing):
+        def _fetched(results):
+            if self._done:
+                return
+            if isinstance(results, TrombiError):
+                self._fail(results)
+                return
+
+            # Revisions gone from the source meanwhile are skipped,
+            # they are replicated with the later changes
+            docs = [x for x in results if not isinstance(x, TrombiError)]
+            self.stats['docs_read'] += len(docs)
+            self._write(batch, docs)
+
+        items = [(doc_id, rev) for doc_id, revs in missing for rev in revs]
+        self.source._bulk_get(
+            items,
+            _fetched,
+            {'revs': True, 'latest': True, 'attachments': True},
+            concurrency=self.fetch_concurrency,
+            )
+
+    def _write(self, batch, docs):
+        if not docs:
+            self._batch_done(batch)
+            return
+
+        def _written(result):
+            if self._done:
+                return
+            if result.error:
+                self._fail(result)
+                return
+
+            # With new_edits=false, CouchDB only reports the failures
+            failures = len([x for x in result if x.error])
+            self.stats['doc_write_failures'] += failures
+            self.stats['docs_written'] += len(docs) - failures
+            self._batch_done(batch)
+
+        self.target.bulk_docs(docs, _written, new_edits=False)
+
+    def _batch_done(self, batch):
+        batch.done = True
+
+        # Only the batches done in order can be checkpointed
+        last_seq = None
+        while self._batches and self._batches[0].done:
+            last_seq = self._batches.pop(0).last_seq
+
+        if last_seq is not None:
+            self.stats['last_seq'] = last_seq
+            self._save_checkpoint(last_seq)
+
+        self._read_next()
+        self._maybe_finish()
+
+    def _save_checkpoint(self, last_seq):
+        if not self.checkpoint:
+            return
+        if self._checkpointing:
+            self._pending_checkpoint = last_seq
+            return
+
+        def _saved(response):
+            self._checkpointing = False
+            if response.code in (200, 201):
+                body = response.json()
+                self._checkpoint_rev = body['rev']
+            else:
+                log.warning('Unable to save replication checkpoint: %s',
+                            _error_response(response))
+
+            pending = self._pending_checkpoint
+            if pending is not None:
+                self._pending_checkpoint = None
+                self._save_checkpoint(pending)
+            else:
+                self._maybe_finish()
+
+        doc = {'source_last_seq': last_seq}
+        if self._checkpoint_rev is not None:
+            doc['_rev'] = self._checkpoint_rev
+
+        self._checkpointing = True
+        self.target._fetch(
+            self._checkpoint_url(),
+            _saved,
+            method='PUT',
+            body=json.dumps(doc),
+            )
+
+    def _maybe_finish(self):
+        if (self._done or self._reading or not self._finished_reading or
+            self._batches or self._checkpointing):
+            return
+        self._done = True
+        self._callback(self.stats)
+
+    def _fail(self, error):
+        if self._done:
+            return
+        self._done = True
+        self._callback(error)
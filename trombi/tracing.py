@@ -0,0 +1,90 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tracing spans around CouchDB requests
+
+Trombi opens a span for every request of a Server given a tracer. The
+classes here do nothing, a bridge to a tracing backend subclasses them.
+"""
+
+# The spans whose callbacks are running, innermost last
+_active = []
+
+
+def active_span():
+    """Returns the span of the innermost running callback, or None."""
+    if _active:
+        return _active[-1]
+    return None
+
+
+class activate(object):
+    """
+    Makes *span* the parent of the requests started inside the with
+    block::
+
+        with trombi.tracing.activate(span):
+            db.get('mydoc', callback)
+    """
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        _active.append(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        _active.pop()
+
+
+def wrap(func, span=None):
+    """
+    Returns *func* wrapped to run with *span* active, by default the
+    span active now. Used for callbacks run later by the IOLoop, so
+    that the requests they start keep their parent.
+    """
+    if span is None:
+        span = active_span()
+    if span is None:
+        return func
+
+    def _wrapped(*args, **kwargs):
+        with activate(span):
+            return func(*args, **kwargs)
+    return _wrapped
+
+
+class Span(object):
+    def set_tag(self, key, value):
+        pass
+
+    def log_event(self, event, timestamp=None):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Tracer(object):
+    def start_span(self, operation_name, parent=None, tags=None):
+        return Span()